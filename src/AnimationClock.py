@@ -0,0 +1,132 @@
+from PyQt5.QtCore import QElapsedTimer, QObject, QTimer, Qt
+from Instrumentation import Instrumentation, profiled
+from FrameStream import FrameStream
+
+class Animation(QObject):
+    '''
+    Playback state of a single animated image shared by all the windows showing it.
+    Frames are scheduled against a running deadline, so a late frame doesn't delay the ones after it.
+    When the event loop falls too far behind, frames are skipped to stay in time.
+    The frames come from a frame stream that decodes them just ahead of the playhead.
+    '''
+    def __init__(self, image, parent=None):
+        super().__init__(parent)
+        self.image = image
+        self.frameIndex = 0
+        self.windows = []
+        self.minFrameInterval = 0 # In ms, frames are skipped to keep the time between them above it
+        self.stream = FrameStream(image, self)
+        self.stream.framesReady.connect(self.showCurrentFrame)
+
+        self.elapsed = QElapsedTimer()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.nextFrame)
+
+    def start(self):
+        self.elapsed.start()
+        self.deadline = self.image.frameDelay(self.frameIndex)
+        self.timer.start(self.deadline)
+
+    def stop(self):
+        self.timer.stop()
+        self.stream.stop()
+
+    def showCurrentFrame(self):
+        '''
+        Show the current frame again, e.g. once the stream caught up after the windows asked for it too early.
+        '''
+        for window in self.windows:
+            window.showFrame(self.frameIndex)
+
+    @profiled
+    def nextFrame(self):
+        '''
+        Advance to the frame that's due now and show it in all the windows at once.
+        '''
+        Instrumentation.countWakeup('animationClock')
+        now = self.elapsed.elapsed()
+        frameIndex = self.frameIndex
+        while True:
+            frameIndex = (frameIndex + 1) % self.image.frameCount()
+            nextDeadline = self.deadline + self.image.frameDelay(frameIndex)
+            if nextDeadline > now:
+                break
+            self.deadline = nextDeadline # Skip the frame, its time has already passed
+
+        self.frameIndex = frameIndex
+        self.deadline = nextDeadline
+        self.stream.setPlayhead(frameIndex)
+        self.showCurrentFrame()
+        self.timer.start(max(self.minFrameInterval, self.deadline - now)) # Frames that are due in the meantime are skipped
+
+class AnimationClock(QObject):
+    '''
+    Single process wide driver for GIF playback.
+    Every animated image has one playhead that tells all the windows showing it which frame to show,
+    so the windows never drift apart and can join or leave without restarting the others.
+    '''
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The clock shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.animations = {} # image key -> Animation
+        self.windowAnimations = {} # window -> Animation
+        self.minFrameInterval = 0 # In ms, lowers the frame rate of all the GIFs, e.g. under load
+
+    def join(self, window, image):
+        '''
+        Start showing image in window. A window joining a running animation starts at the current frame.
+        '''
+        self.leave(window)
+
+        animation = self.animations.get(image.key)
+        if animation is None:
+            animation = Animation(image, self)
+            animation.minFrameInterval = self.minFrameInterval
+            self.animations[image.key] = animation
+            animation.start()
+
+        animation.windows.append(window)
+        self.windowAnimations[window] = animation
+        window.showFrame(animation.frameIndex)
+
+    def leave(self, window):
+        '''
+        Stop updating window. The animation stops once no window shows it anymore.
+        '''
+        animation = self.windowAnimations.pop(window, None)
+        if animation is None:
+            return
+
+        animation.windows.remove(window)
+        if not animation.windows:
+            animation.stop()
+            del self.animations[animation.image.key]
+            animation.deleteLater()
+
+    def setMinFrameInterval(self, interval):
+        '''
+        Play all the GIFs with at least interval ms between frames, 0 plays every frame.
+        The animations stay on time, the frames in between are skipped.
+        '''
+        self.minFrameInterval = interval
+        for animation in self.animations.values():
+            animation.minFrameInterval = interval
+
+    def stream(self, window):
+        '''
+        Frame stream of the animation window is part of, None if it isn't part of one.
+        '''
+        animation = self.windowAnimations.get(window)
+        return animation.stream if animation else None
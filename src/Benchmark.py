@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen') # Headless unless a platform was chosen explicitly
+invocationDir = os.getcwd() # Paths given on the command line are relative to it
+os.chdir(os.path.dirname(os.path.abspath(__file__))) # The app loads its files relative to src
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QCoreApplication, QElapsedTimer, QEvent, QEventLoop, QObject, QPoint, QT_VERSION_STR, QTimer
+from PyQt5.QtGui import QGuiApplication
+from MainWindow import MainWindow
+from ImageWindow import ImageWindow
+from ImageLoader import ImageLoader
+from AnimationClock import AnimationClock
+from Instrumentation import LagProbe
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+def peakRss():
+    '''
+    Peak resident set size of the process in bytes, None if it can't be measured on this platform.
+    '''
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # macOS reports bytes, Linux KB
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+def currentRss():
+    '''
+    Resident set size of the process right now in bytes, None if it can't be measured on this platform.
+    '''
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError): # Not Linux
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+def timerCounts():
+    '''
+    Number of timers owned by the app's widgets and process wide objects, and how many of them are running.
+    '''
+    roots = QApplication.topLevelWidgets() + [AnimationClock.instance(), ImageLoader.instance()]
+    timers = {timer for root in roots for timer in root.findChildren(QTimer)}
+    return len(timers), sum(timer.isActive() for timer in timers)
+
+class PaintCounter(QObject):
+    '''
+    Counts the repaints of the images in the image windows, used to derive the frames per second.
+    '''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paints = 0
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and isinstance(obj.parent(), ImageWindow):
+            self.paints += 1
+        return False
+
+class Benchmark:
+    '''
+    Drives the main window through scripted scenarios and measures how the app scales with the number of image windows.
+    For every scenario it reports the wall time, CPU time per second, event loop latency, peak RSS and frames per second.
+    '''
+    WINDOW_COUNTS = (1, 10, 50, 99)
+    SOAK_WINDOWS = 10 # Windows opened and closed in every cycle of the soak test
+    STARTUP_RUNS = 5 # Startup is measured in fresh processes, the median of the runs is reported
+
+    def __init__(self, app, soakCycles=200):
+        self.app = app
+        self.soakCycles = soakCycles
+        self.mainWindow = MainWindow()
+        self.mainWindow.show()
+        self.lagProbe = LagProbe()
+        self.paintCounter = PaintCounter()
+        app.installEventFilter(self.paintCounter)
+        self.results = []
+
+        self.tempDir = tempfile.mkdtemp()
+        self.gifPaths = ['Files/tess.gif', os.path.join(self.tempDir, 'tess-copy.gif')] # Same GIF under a second path, decoded separately
+        shutil.copy(self.gifPaths[0], self.gifPaths[1])
+
+    def wait(self, ms):
+        '''
+        Run the event loop for ms milliseconds.
+        '''
+        loop = QEventLoop()
+        QTimer.singleShot(ms, loop.quit)
+        loop.exec_()
+
+    def waitUntil(self, condition, timeout=30000):
+        '''
+        Run the event loop until condition is met or timeout ms have passed.
+        '''
+        elapsed = QElapsedTimer()
+        elapsed.start()
+        while not condition() and elapsed.elapsed() < timeout:
+            self.wait(5)
+
+    def imagesLoaded(self):
+        return all(window.image for window in self.mainWindow.imageWindows) and not ImageLoader.instance().jobs
+
+    def measure(self, name, scenario):
+        '''
+        Run a scenario and record its metrics.
+        '''
+        self.paintCounter.paints = 0
+        self.lagProbe.start()
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+
+        scenario()
+
+        wallTime = time.perf_counter() - wallStart
+        cpuTime = time.process_time() - cpuStart
+        self.lagProbe.stop()
+
+        numWindows = len(self.mainWindow.imageWindows)
+        result = {
+            'scenario': name,
+            'windows': numWindows,
+            'wallTime': round(wallTime, 4),
+            'cpuPerSecond': round(cpuTime / wallTime, 4) if wallTime else 0,
+            'eventLoopLag': self.lagProbe.summary(),
+            'peakRss': peakRss(),
+            'fps': round(self.paintCounter.paints / numWindows / wallTime, 2) if numWindows and wallTime else 0,
+        }
+        self.results.append(result)
+        print('{scenario:>16}  windows={windows:<3} wall={wallTime:.3f}s cpu/s={cpuPerSecond:.2f} lag.p95={lag}ms fps={fps}'.format(lag=result['eventLoopLag']['p95'], **result), file=sys.stderr)
+        return result
+
+    def measureStartup(self):
+        '''
+        Start the app in fresh processes with --profile-startup and record the median time to first paint and to interactive.
+        '''
+        runs = []
+        for run in range(self.STARTUP_RUNS):
+            output = subprocess.run([sys.executable, 'MultiWindowTest.py', '--profile-startup'], capture_output=True, text=True, timeout=60).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        result = {
+            'scenario': 'startup',
+            'windows': 0,
+            'wallTime': statistics.median(run['interactive'] for run in runs),
+            'firstPaint': statistics.median(run['firstPaint'] for run in runs),
+            'imports': statistics.median(run['imports'] for run in runs),
+        }
+        self.results.append(result)
+        print('{scenario:>16}  imports={imports:.3f}s firstPaint={firstPaint:.3f}s interactive={wallTime:.3f}s'.format(**result), file=sys.stderr)
+        return result
+
+    def openWindows(self, numWindows):
+        self.mainWindow.closeAllImageWindows()
+        self.mainWindow.openWindows(numWindows)
+        self.waitUntil(lambda: not self.mainWindow.windowsToOpen and self.imagesLoaded())
+        self.wait(500) # Let the windows settle, e.g. the smooth scaling and the sync scheduler
+
+    def dragWindow(self, steps=120, direction=1):
+        '''
+        Move the first window in small steps at roughly the rate a mouse drag produces move events.
+        A direction of -1 drags it back to where the previous drag started.
+        '''
+        window = self.mainWindow.imageWindows[0]
+        start = window.pos()
+        for step in range(steps):
+            window.move(start + QPoint(step * 4, step * 2) * direction)
+            self.wait(8)
+        self.wait(500)
+
+    def withRefreshRate(self, button, scenario):
+        '''
+        Run a scenario with another refresh rate selected, then switch back to the default one.
+        '''
+        button.setChecked(True)
+        self.mainWindow.updateTimeStep()
+        scenario()
+        self.mainWindow.fastR.setChecked(True)
+        self.mainWindow.updateTimeStep()
+
+    def sweepScale(self):
+        '''
+        Drag the scale slider over its whole range and release it.
+        '''
+        slider = self.mainWindow.scaleSlider
+        slider.setSliderDown(True)
+        for value in list(range(slider.minimum(), slider.maximum(), 5)) + [100]:
+            slider.setValue(value)
+            self.wait(8)
+        slider.setSliderDown(False) # Emits sliderReleased
+        self.waitUntil(lambda: not ImageLoader.instance().jobs and not self.mainWindow.scaleIdleTimer.isActive())
+        self.wait(500)
+
+    def swapGifs(self, swaps=4):
+        for swap in range(swaps):
+            self.mainWindow.currentImagePath = self.gifPaths[(swap + 1) % 2]
+            self.mainWindow.updateAllWindows()
+            self.waitUntil(self.imagesLoaded)
+            self.wait(250)
+
+    def soak(self):
+        '''
+        Open and close a batch of windows over and over. The memory, the number of timers and of windows should stay flat,
+        closed windows are released and reused by the window pool.
+        '''
+        stats = {'cycles': self.soakCycles, 'rss': [], 'timers': [], 'activeTimers': [], 'windowsAlive': []}
+        sampleEvery = max(1, self.soakCycles // 10)
+        for cycle in range(self.soakCycles + 1): # The first cycle fills the window pool and isn't sampled
+            self.mainWindow.openWindows(self.SOAK_WINDOWS)
+            self.waitUntil(lambda: not self.mainWindow.windowsToOpen)
+            self.wait(1)
+            self.mainWindow.closeAllImageWindows()
+            self.wait(1)
+            # The benchmark runs outside of the app's event loop, where objects scheduled for deletion from within an event
+            # are never deleted. Delete them here like the app's event loop would.
+            QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+            if cycle % sampleEvery == 0:
+                timers, activeTimers = timerCounts()
+                stats['rss'].append(currentRss())
+                stats['timers'].append(timers)
+                stats['activeTimers'].append(activeTimers)
+                stats['windowsAlive'].append(len(self.mainWindow.findChildren(ImageWindow)))
+        self.soakStats = stats
+
+    def run(self):
+        self.measureStartup()
+        for numWindows in self.WINDOW_COUNTS:
+            self.measure('open', lambda: self.openWindows(numWindows))
+        self.measure('idle', lambda: self.wait(2000))
+        self.measure('drag', self.dragWindow)
+        self.measure('drag auto', lambda: self.withRefreshRate(self.mainWindow.autoR, lambda: self.dragWindow(direction=-1)))
+        self.measure('scale sweep', self.sweepScale)
+        self.measure('swap gifs', self.swapGifs)
+        self.measure('close all', lambda: (self.mainWindow.closeAllImageWindows(), self.wait(250)))
+        if self.soakCycles:
+            result = self.measure('soak', self.soak)
+            result.update(self.soakStats)
+            rss = [value for value in self.soakStats['rss'] if value]
+            print('{:>16}  cycles={} rss.growth={}KB timers={} windowsAlive={}'.format('soak', self.soakCycles, (rss[-1] - rss[0]) // 1024 if rss else None,
+                  self.soakStats['timers'], self.soakStats['windowsAlive']), file=sys.stderr)
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+        return self.report()
+
+    def report(self):
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'qpa': QGuiApplication.platformName(),
+            'results': self.results,
+        }
+
+def compare(report, baseline):
+    '''
+    Print how the wall and CPU time of every scenario, and the time to first paint, changed relative to a previous run.
+    '''
+    previous = {(result['scenario'], result['windows']): result for result in baseline['results']}
+    for result in report['results']:
+        old = previous.get((result['scenario'], result['windows']))
+        if not old:
+            continue
+        for metric in ('wallTime', 'cpuPerSecond', 'firstPaint'):
+            if old.get(metric) and metric in result:
+                print('{:>16}  windows={:<3} {:<12} {:+.1%}'.format(result['scenario'], result['windows'], metric, result[metric] / old[metric] - 1), file=sys.stderr)
+
+def main():
+    '''
+    Runs the benchmark and writes the results as JSON, to stdout unless an output file is given.
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark how the app scales with the number of image windows.')
+    parser.add_argument('--output', help='File to write the JSON results to')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--soak-cycles', type=int, default=200, help='Open/close cycles of the soak test, 0 skips it')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    report = Benchmark(app, args.soak_cycles).run()
+
+    if args.baseline:
+        with open(os.path.join(invocationDir, args.baseline)) as file:
+            compare(report, json.load(file))
+    if args.output:
+        with open(os.path.join(invocationDir, args.output), 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import mmap
+import struct
+import hashlib
+from PyQt5.QtCore import QStandardPaths
+from PyQt5.QtGui import QImage
+from PyQt5 import sip
+
+class FrameDiskCache:
+    '''
+    On-disk cache of decoded and scaled frames, written when a session is saved so restoring it doesn't decode anything.
+    Every frame is a file with a small header followed by the raw pixels, which are memory-mapped and used in place,
+    so loading a frame costs next to nothing and the pages are shared with the file system cache.
+    Files are named after the cache key, which includes the modification time of the image, so changed files are never served.
+    '''
+    MAGIC = b'MWSF'
+    HEADER = struct.Struct('<4s5i') # magic, version, width, height, bytes per line, format
+    VERSION = 1
+    MAX_BYTES = 1024 * 1024 * 1024 # Oldest files are deleted once the cache grows beyond this
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The disk cache shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), 'MultiWindowSync', 'frames')
+        self.mappings = {} # File name -> mmap, kept open for as long as the frames mapped from it may be in use
+
+    def fileName(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.frame')
+
+    def save(self, key, image):
+        '''
+        Write a frame under key, unless it's already on disk.
+        The file is written under a temporary name and renamed, so a mapped older version is never modified.
+        '''
+        fileName = self.fileName(key)
+        if os.path.exists(fileName):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, image.width(), image.height(), image.bytesPerLine(), int(image.format()))
+        with open(fileName + '.tmp', 'wb') as file:
+            file.write(header)
+            file.write(image.constBits().asstring(image.sizeInBytes()))
+        os.replace(fileName + '.tmp', fileName)
+
+    def load(self, key):
+        '''
+        The frame stored under key, mapped straight from the file, None if it isn't on disk.
+        '''
+        fileName = self.fileName(key)
+        mapping = self.mappings.get(fileName)
+        if mapping is None:
+            try:
+                with open(fileName, 'rb') as file:
+                    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+            self.mappings[fileName] = mapping
+
+        if len(mapping) < self.HEADER.size:
+            return None
+        magic, version, width, height, bytesPerLine, imageFormat = self.HEADER.unpack_from(mapping)
+        if magic != self.MAGIC or version != self.VERSION or len(mapping) < self.HEADER.size + bytesPerLine * height:
+            return None
+        return QImage(sip.voidptr(memoryview(mapping)[self.HEADER.size:]), width, height, bytesPerLine, QImage.Format(imageFormat))
+
+    def trim(self):
+        '''
+        Delete the least recently written files until the cache fits into MAX_BYTES.
+        Files that are mapped by this process are kept.
+        '''
+        try:
+            entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.frame')]
+        except OSError:
+            return
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        for entry in entries:
+            if total <= self.MAX_BYTES:
+                break
+            if entry not in self.mappings:
+                total -= os.path.getsize(entry)
+                os.remove(entry)
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from PyQt5.QtCore import QObject, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QPixmap
+from ImageLoader import ImageLoader
+from SourceFiles import SourceFiles
+
+class FrameStream(QObject):
+    '''
+    Streams the frames of an animated image with QImageReader instead of decoding all of them up front.
+    Only a small ring buffer of frames from the playhead onwards is kept, and every frame is smoothly scaled ahead of time
+    to each size windows show it at. All the windows showing the image share the buffer, so memory stays constant
+    however many frames the GIF has and however many windows show it.
+    Decoding and scaling run on the image loader's worker pool, a single job per stream at a time since the reader is sequential.
+    '''
+    BUFFER_SIZE = 8 # Frames kept ahead of the playhead
+    MAX_DRAFTS = 8 # Approximately scaled frames shown until the smoothly scaled ones arrive
+    framesReady = pyqtSignal() # New frames arrived after a window asked for one that wasn't decoded yet
+
+    def __init__(self, image, parent=None):
+        super().__init__(parent)
+        self.image = image
+        self.path = image.key[0]
+        self.playhead = 0
+        self.stalled = False
+        self.sourceFrames = OrderedDict() # frame index -> decoded frame at the decode scale
+        self.sourcePixmaps = {} # frame index -> decoded frame as a pixmap, for the shared canvas mode
+        self.scaledFrames = {} # (width, height, aspect mode) -> {frame index -> smoothly scaled pixmap}
+        self.sizeUses = {} # (width, height, aspect mode) -> frames since a window last asked for that size
+        self.drafts = OrderedDict() # (frame index, width, height, aspect mode) -> quickly scaled pixmap
+        self.job = None
+        self.source = SourceFiles.instance().file(self.path) # The bytes of the file, shared with the workers
+        self.failed = self.source is None or self.source.key() != image.key[:2] # Set once the file can't be read anymore, so it isn't retried on every frame
+        self.reader = self.createReader(self.source, image.decodeScale) if not self.failed else None
+        self.nextIndex = 0 # Index of the frame the reader returns next
+        self.fill()
+
+    @staticmethod
+    def createReader(source, decodeScale):
+        '''
+        A reader positioned at the first frame, decoding at the same scale as the image in the cache.
+        '''
+        reader = source.reader()
+        fullSize = reader.size()
+        if decodeScale < 1 and fullSize.isValid():
+            reader.setScaledSize(QSize(max(1, round(fullSize.width() * decodeScale)), max(1, round(fullSize.height() * decodeScale))))
+        return reader
+
+    def window(self):
+        '''
+        Indexes of the frames that belong in the buffer, from the playhead onwards.
+        '''
+        frameCount = self.image.frameCount()
+        return [(self.playhead + offset) % frameCount for offset in range(min(self.BUFFER_SIZE, frameCount))]
+
+    def setPlayhead(self, frameIndex):
+        '''
+        Move on to frameIndex, drop the frames behind it and decode the ones that are now in reach.
+        '''
+        self.playhead = frameIndex
+        window = set(self.window())
+        for index in [index for index in self.sourceFrames if index not in window]:
+            del self.sourceFrames[index]
+            self.sourcePixmaps.pop(index, None)
+        for sizeKey, frames in list(self.scaledFrames.items()):
+            self.sizeUses[sizeKey] += 1
+            if self.sizeUses[sizeKey] > self.BUFFER_SIZE: # No window shows the frames at that size anymore
+                del self.scaledFrames[sizeKey], self.sizeUses[sizeKey]
+                continue
+            for index in [index for index in frames if index not in window]:
+                del frames[index]
+        self.fill()
+
+    def frame(self, frameIndex, size=None, aspectMode=Qt.IgnoreAspectRatio, smooth=True):
+        '''
+        A frame as a pixmap, scaled to size if one is given, or None if it hasn't been decoded yet.
+        Asking for a size registers it, the frames after it are then smoothly scaled to it ahead of time.
+        Until they are, and with smooth unset, the frame is quickly scaled from the decoded frame instead.
+        '''
+        source = self.sourceFrames.get(frameIndex)
+        if source is None:
+            self.stalled = True
+            self.fill()
+            return None
+
+        if size is None or size == source.size():
+            pixmap = self.sourcePixmaps.get(frameIndex)
+            if pixmap is None:
+                pixmap = self.sourcePixmaps[frameIndex] = QPixmap.fromImage(source)
+            return pixmap
+
+        sizeKey = (size.width(), size.height(), aspectMode)
+        if smooth:
+            frames = self.scaledFrames.get(sizeKey)
+            if frames is None:
+                frames = self.scaledFrames[sizeKey] = {}
+                self.fill() # Scale the buffered frames to the new size as well
+            self.sizeUses[sizeKey] = 0
+            pixmap = frames.get(frameIndex)
+            if pixmap is not None:
+                return pixmap
+
+        draftKey = (frameIndex,) + sizeKey
+        pixmap = self.drafts.get(draftKey)
+        if pixmap is None:
+            pixmap = self.drafts[draftKey] = QPixmap.fromImage(source.scaled(size, aspectMode, Qt.FastTransformation))
+            if len(self.drafts) > self.MAX_DRAFTS:
+                self.drafts.popitem(last=False)
+        return pixmap
+
+    def fill(self):
+        '''
+        Decode the missing frames of the buffer and scale them to every registered size in the background.
+        Frames between the reader and the playhead are decoded and dropped, GIFs can only be read in order.
+        '''
+        if self.job or self.failed:
+            return
+        window = self.window()
+        needed = [index for index in window if index not in self.sourceFrames]
+        sizes = list(self.scaledFrames)
+        toScale = [(index, self.sourceFrames[index], [sizeKey for sizeKey in sizes if index not in self.scaledFrames[sizeKey]])
+                   for index in window if index in self.sourceFrames]
+        toScale = [(index, source, missing) for index, source, missing in toScale if missing]
+        if not needed and not toScale:
+            return
+
+        startReader, startIndex, frameCount = self.reader, self.nextIndex, self.image.frameCount()
+        source, decodeScale = self.source, self.image.decodeScale
+        needed = set(needed)
+
+        def scale(source, sizeKeys):
+            return {sizeKey: source.scaled(QSize(sizeKey[0], sizeKey[1]), sizeKey[2], Qt.SmoothTransformation) for sizeKey in sizeKeys}
+
+        def decode(job):
+            reader, nextIndex, count = startReader, startIndex, frameCount
+            scaled = [(index, scale(source, missing)) for index, source, missing in toScale]
+            decoded = []
+            while needed and not job.cancelled:
+                frame = reader.read()
+                if frame.isNull():
+                    if nextIndex == 0: # Not even the first frame can be read, the file is broken or gone
+                        break
+                    count = nextIndex # Fewer frames than the header said, loop early
+                    needed.intersection_update(range(count))
+                    reader, nextIndex = self.createReader(source, decodeScale), 0
+                    continue
+                index, delay = nextIndex, reader.nextImageDelay()
+                nextIndex = (nextIndex + 1) % count
+                if nextIndex == 0:
+                    reader = self.createReader(source, decodeScale) # Looping, the next read starts from the first frame again
+                if index in needed:
+                    needed.discard(index)
+                    decoded.append((index, frame, delay, scale(frame, sizes)))
+            return reader, nextIndex, count, decoded, scaled
+
+        self.job = ImageLoader.instance().startJob(decode, self.onFilled)
+
+    def onFilled(self, job, result):
+        if job is not self.job:
+            return
+        self.job = None
+        if result is None or not (result[3] or result[4]):
+            self.failed = True
+            return
+
+        self.reader, self.nextIndex, frameCount, decoded, scaled = result
+        self.image.setFrameCount(frameCount)
+        window = set(self.window()) # The playhead may have moved on while the job was running
+        for index, frame, delay, scaledFrames in decoded:
+            if index not in window:
+                continue
+            self.sourceFrames[index] = frame
+            self.image.delays[index] = delay
+            scaled.append((index, scaledFrames))
+        for index, scaledFrames in scaled:
+            if index not in window:
+                continue
+            for sizeKey, scaledFrame in scaledFrames.items():
+                if sizeKey in self.scaledFrames:
+                    self.scaledFrames[sizeKey][index] = QPixmap.fromImage(scaledFrame)
+
+        if self.stalled:
+            self.stalled = False
+            self.framesReady.emit()
+        self.fill()
+
+    def stop(self):
+        '''
+        Stop decoding, e.g. once no window shows the animation anymore.
+        '''
+        if self.job:
+            ImageLoader.instance().cancelJob(self.job)
+            self.job = None
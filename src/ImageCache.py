@@ -0,0 +1,373 @@
+from collections import OrderedDict
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QImageIOHandler, QPixmap
+from SourceFiles import SourceFiles
+
+class CachedImage:
+    '''
+    Decoded frames of a single image file, shared by every window that shows the file.
+    Still images have a single frame. Of animated images only the first frame is kept, e.g. for the preview,
+    the others are streamed by a frame stream while they play. Their delays are filled in as they're decoded.
+    '''
+    DEFAULT_DELAY = 100 # Frame delay in ms for GIFs that don't specify one
+
+    def __init__(self, key, frames, delays, frameCount=None):
+        self.key = key # (path, mtime, decode scale) the image was decoded from
+        self.frames = frames
+        self.delays = delays
+        self.count = frameCount or len(frames)
+        self.delays += [0] * (self.count - len(delays))
+
+    @property
+    def decodeScale(self):
+        return self.key[2]
+
+    @property
+    def isAnimated(self):
+        return self.count > 1
+
+    def frameCount(self):
+        return self.count
+
+    def setFrameCount(self, frameCount):
+        '''
+        Correct the frame count once streaming found out the header was wrong about it.
+        '''
+        self.count = frameCount
+        del self.delays[frameCount:]
+
+    def size(self):
+        return self.frames[0].size()
+
+    def frameDelay(self, frameIndex):
+        return self.delays[frameIndex] or self.DEFAULT_DELAY
+
+    def byteCount(self):
+        return sum(frame.sizeInBytes() for frame in self.frames)
+
+class ImageCache:
+    '''
+    Process wide cache of decoded images shared by all the image windows and the preview in the main window.
+    Images are keyed by path and modification time, so every file is decoded once and decoded again only after it changed on disk.
+    Files are decoded at the smallest of a few fixed fractions of their full size that still covers the size they're shown at,
+    formats like JPEG decode straight to that size which saves most of the time and memory of decoding big files.
+    Scaled pixmaps of the frames are cached as well, the least recently used entries are evicted once the memory budget is exceeded.
+    Approximately scaled pixmaps count against the same budget, they're the first to go since they're cheap to make again.
+    Once the last entry of a file is evicted, the file layer lets go of the file.
+    For fast approximate scaling, e.g. while the scale slider is dragged, every frame has a pyramid of pre-scaled versions halving in size.
+    The cache itself is only used from the GUI thread, the static decode and scale methods are what the image loader runs in its workers.
+    '''
+    DEFAULT_BUDGET = 512 * 1024 * 1024 # In bytes
+    MIN_LEVEL_SIZE = 64 # Smallest side of the last level of a pyramid
+    MAX_DRAFTS = 32 # Number of approximately scaled pixmaps kept around, as long as they fit into the memory budget
+    DECODE_SCALES = (0.125, 0.25, 0.5, 1) # Fractions of the full size images are decoded at, JPEG can decode all of them natively
+    MAX_DECODE_PIXELS = 16 * 1024 * 1024 # Larger images are only decoded as an overview, the details come from the tile cache
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The cache shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, memoryBudget=DEFAULT_BUDGET):
+        self.memoryBudget = memoryBudget
+        self.memoryUsed = 0
+        self.entries = OrderedDict() # key -> (value, cost), ordered from least to most recently used
+        self.drafts = OrderedDict() # Approximately scaled pixmaps, kept out of the entries so they don't evict the exact ones
+        self.headers = {} # (path, mtime) -> (full size, whether the format is animated, whether it decodes clip rects), read without decoding
+        self.pathEntries = {} # path -> number of entries cached for the file
+
+    def setMemoryBudget(self, memoryBudget):
+        '''
+        Change the memory budget in bytes and evict entries until the cache fits into it.
+        '''
+        self.memoryBudget = memoryBudget
+        self.evict()
+
+    @staticmethod
+    def imageKey(path):
+        '''
+        (path, mtime) identifying the current version of the file at path, None if it doesn't exist.
+        The file layer watches the file, so this doesn't touch the disk unless it has changed.
+        '''
+        return SourceFiles.instance().key(path)
+
+    def header(self, key):
+        '''
+        Full size of the image identified by key, whether its format is animated and whether it decodes a clip rect
+        without decoding the whole image, read from the file header only.
+        '''
+        header = self.headers.get(key)
+        if header is None:
+            reader = SourceFiles.instance().reader(key[0])
+            header = self.headers[key] = (reader.size(), reader.supportsAnimation(), reader.supportsOption(QImageIOHandler.ClipRect))
+        return header
+
+    def decodeScale(self, path, targetSize=None):
+        '''
+        Smallest decode scale at which the image at path still covers targetSize, the full size if there's no targetSize.
+        Still images are fitted into targetSize keeping their aspect ratio, GIFs are stretched to it.
+        Very large images are never decoded at more than MAX_DECODE_PIXELS.
+        '''
+        key = self.imageKey(path)
+        if key is None:
+            return 1
+        fullSize, animated, clips = self.header(key)
+        if not fullSize.isValid():
+            return 1
+
+        maxScale = self.DECODE_SCALES[0]
+        for scale in self.DECODE_SCALES:
+            if fullSize.width() * fullSize.height() * scale * scale <= self.MAX_DECODE_PIXELS:
+                maxScale = scale
+        if targetSize is None:
+            return maxScale
+
+        neededSize = fullSize.scaled(targetSize, Qt.IgnoreAspectRatio if animated else Qt.KeepAspectRatio)
+        for scale in self.DECODE_SCALES:
+            if fullSize.width() * scale >= neededSize.width() and fullSize.height() * scale >= neededSize.height():
+                return min(scale, maxScale)
+        return maxScale
+
+    def isTiled(self, cachedImage):
+        '''
+        Whether the image is too large to be decoded at full size, so details have to come from the tile cache.
+        Only formats that decode a clip rect natively, like JPEG, are tiled. Others, like PNG, would decode the whole image
+        for every tile, so they're only shown from the overview.
+        '''
+        fullSize, animated, clips = self.header(cachedImage.key[:2])
+        return clips and not animated and fullSize.width() * fullSize.height() > self.MAX_DECODE_PIXELS
+
+    def image(self, path, targetSize=None):
+        '''
+        Decoded frames of the image at path, or None if the file can't be decoded.
+        The file is decoded right away on the calling thread if it isn't cached at a large enough scale yet.
+        '''
+        cachedImage = self.cachedImage(path, targetSize)
+        if cachedImage is None:
+            key = self.imageKey(path)
+            if key is None:
+                return None
+            cachedImage = self.decode(SourceFiles.instance().reader(path), key + (self.decodeScale(path, targetSize),))
+            if cachedImage is None:
+                return None
+            self.addImage(cachedImage)
+        return cachedImage
+
+    def cachedImage(self, path, targetSize=None, allowSmaller=False):
+        '''
+        Decoded frames of the image at path if they're already cached at a scale large enough for targetSize, None otherwise.
+        With allowSmaller set, the largest cached version is returned if none of them is large enough, e.g. to show until a larger one is decoded.
+        '''
+        key = self.imageKey(path)
+        if key is None:
+            return None
+
+        minScale = self.decodeScale(path, targetSize)
+        smaller = None
+        for scale in self.DECODE_SCALES:
+            cachedImage = self.lookup(('image',) + key + (scale,))
+            if cachedImage is None:
+                continue
+            if scale >= minScale:
+                return cachedImage
+            smaller = cachedImage
+        return smaller if allowSmaller else None
+
+    def addImage(self, cachedImage, pyramids=None):
+        '''
+        Add an image decoded elsewhere, e.g. by the image loader, along with the pyramids of its frames.
+        '''
+        self.insert(('image',) + cachedImage.key, cachedImage, cachedImage.byteCount())
+        for frameIndex, levels in enumerate(pyramids or []):
+            self.insert(('pyramid', cachedImage.key, frameIndex), levels, sum(level.sizeInBytes() for level in levels[1:]))
+
+    def pixmap(self, cachedImage, frameIndex=0, size=None, aspectMode=Qt.KeepAspectRatio, smooth=True):
+        '''
+        A frame of a decoded image as a pixmap, scaled to size if one is given.
+        Unless smooth is set, it's quickly scaled from the closest level of the pyramid instead of smoothly from the decoded frame.
+        Windows of the same size share the same scaled pixmap.
+        '''
+        frame = cachedImage.frames[frameIndex]
+        if size is None:
+            size = frame.size()
+        if not smooth and size != frame.size():
+            return self.draftPixmap(cachedImage, frameIndex, size, aspectMode)
+
+        pixmap = self.scaledPixmap(cachedImage, frameIndex, size, aspectMode)
+        if pixmap is None:
+            scaledFrame = frame if size == frame.size() else self.scaleFrame(frame, size, aspectMode)
+            pixmap = self.addScaledFrame(cachedImage, frameIndex, size, aspectMode, scaledFrame)
+        return pixmap
+
+    def scaledPixmap(self, cachedImage, frameIndex, size, aspectMode):
+        '''
+        The smoothly scaled pixmap of a frame if it's already cached, None otherwise.
+        '''
+        return self.lookup(('pixmap', cachedImage.key, frameIndex, size.width(), size.height(), aspectMode))
+
+    def addScaledFrame(self, cachedImage, frameIndex, size, aspectMode, scaledFrame):
+        '''
+        Add a frame that was smoothly scaled elsewhere, e.g. by the image loader, and return it as a pixmap.
+        '''
+        pixmap = QPixmap.fromImage(scaledFrame)
+        key = ('pixmap', cachedImage.key, frameIndex, size.width(), size.height(), aspectMode)
+        self.insert(key, pixmap, self.pixmapCost(pixmap))
+        return pixmap
+
+    @staticmethod
+    def pixmapCost(pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def draftPixmap(self, cachedImage, frameIndex, size, aspectMode):
+        '''
+        A frame quickly scaled from the smallest pyramid level that's still larger than the target size.
+        '''
+        key = (cachedImage.key, frameIndex, size.width(), size.height(), aspectMode)
+        pixmap = self.drafts.get(key)
+        if pixmap is not None:
+            self.drafts.move_to_end(key)
+            return pixmap
+
+        levels = self.pyramid(cachedImage, frameIndex)
+        targetSize = levels[0].size().scaled(size, aspectMode)
+        source = levels[0]
+        for level in levels[1:]:
+            if level.width() < targetSize.width() or level.height() < targetSize.height():
+                break
+            source = level
+
+        pixmap = QPixmap.fromImage(source.scaled(size, aspectMode, Qt.FastTransformation))
+        self.drafts[key] = pixmap
+        self.memoryUsed += self.pixmapCost(pixmap)
+        if len(self.drafts) > self.MAX_DRAFTS:
+            self.removeDraft(next(iter(self.drafts)))
+        self.evict()
+        return pixmap
+
+    def removeDraft(self, key):
+        self.memoryUsed -= self.pixmapCost(self.drafts.pop(key))
+
+    def pyramid(self, cachedImage, frameIndex):
+        '''
+        Pre-scaled versions of a frame, each level half the size of the previous one.
+        The first level is the decoded frame itself.
+        '''
+        key = ('pyramid', cachedImage.key, frameIndex)
+        levels = self.lookup(key)
+        if levels is None:
+            levels = self.buildPyramid(cachedImage.frames[frameIndex])
+            self.insert(key, levels, sum(level.sizeInBytes() for level in levels[1:]))
+        return levels
+
+    @classmethod
+    def buildPyramid(cls, frame):
+        '''
+        Levels of the pyramid of a frame, each half the size of the previous one.
+        '''
+        levels = [frame]
+        while min(levels[-1].width(), levels[-1].height()) >= 2 * cls.MIN_LEVEL_SIZE:
+            last = levels[-1]
+            levels.append(last.scaled(last.width() // 2, last.height() // 2, Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        return levels
+
+    @staticmethod
+    def scaleFrame(frame, size, aspectMode):
+        return frame.scaled(size, aspectMode, Qt.SmoothTransformation)
+
+    @staticmethod
+    def decode(reader, key, job=None):
+        '''
+        Decode the file reader reads at the decode scale that's part of the key.
+        Of animated images only the first frame is decoded, the rest are streamed while they play.
+        Returns None if the file can't be decoded or once the job it runs for is cancelled.
+        '''
+        scale = key[2]
+        fullSize = reader.size()
+        if scale < 1 and fullSize.isValid():
+            reader.setScaledSize(QSize(max(1, round(fullSize.width() * scale)), max(1, round(fullSize.height() * scale))))
+        frameCount = reader.imageCount() if reader.supportsAnimation() else 1
+        frame = reader.read()
+        if frame.isNull() or (job and job.cancelled):
+            return None
+        return CachedImage(key, [frame], [reader.nextImageDelay()], max(1, frameCount))
+
+    def discard(self, path):
+        '''
+        Drop everything cached for the older versions of the file at path once it has changed on disk.
+        Returns the largest scale an older version was decoded at, None if none was cached.
+        '''
+        current = self.imageKey(path)
+        isStale = lambda imageKey: imageKey[0] == path and imageKey[:2] != current
+        largestScale = None
+        for key in list(self.entries):
+            imageKey = key[1:] if key[0] == 'image' else key[1]
+            if isStale(imageKey):
+                if key[0] == 'image':
+                    largestScale = max(largestScale or 0, imageKey[2])
+                self.remove(key, release=False) # The file was just read again for its new version
+        for key in [key for key in self.drafts if isStale(key[0])]:
+            self.removeDraft(key)
+        for key in [key for key in self.headers if isStale(key)]:
+            del self.headers[key]
+        return largestScale
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key) # Most recently used
+        return entry[0]
+
+    def insert(self, key, value, cost):
+        if key in self.entries:
+            self.memoryUsed -= self.entries[key][1]
+        else:
+            path = self.entryPath(key)
+            self.pathEntries[path] = self.pathEntries.get(path, 0) + 1
+        self.entries[key] = (value, cost)
+        self.memoryUsed += cost
+        self.evict()
+
+    @staticmethod
+    def entryPath(key):
+        return key[1] if key[0] == 'image' else key[1][0]
+
+    def remove(self, key, release=True):
+        '''
+        Drop an entry. Once none is left for its file, the header is dropped too and unless release is unset the file layer forgets the file.
+        '''
+        self.memoryUsed -= self.entries.pop(key)[1]
+        path = self.entryPath(key)
+        self.pathEntries[path] -= 1
+        if self.pathEntries[path]:
+            return
+        del self.pathEntries[path]
+        if release:
+            for headerKey in [headerKey for headerKey in self.headers if headerKey[0] == path]:
+                del self.headers[headerKey]
+            SourceFiles.instance().release(path)
+
+    def evict(self):
+        '''
+        Drop the least recently used drafts and then entries until the cache fits into the memory budget.
+        The most recent draft and entry are always kept so that a single oversized image still works.
+        '''
+        while self.memoryUsed > self.memoryBudget and len(self.drafts) > 1:
+            self.removeDraft(next(iter(self.drafts)))
+        while self.memoryUsed > self.memoryBudget and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+
+    def clear(self):
+        for path in self.pathEntries:
+            SourceFiles.instance().release(path)
+        self.entries.clear()
+        self.drafts.clear()
+        self.headers.clear()
+        self.pathEntries.clear()
+        self.memoryUsed = 0
@@ -0,0 +1,193 @@
+from PyQt5.QtCore import QCoreApplication, QObject, QRunnable, QSize, QThreadPool, pyqtSignal
+from ImageCache import ImageCache
+from SourceFiles import SourceFiles
+
+class JobSignals(QObject):
+    '''
+    Carries the result of a job from the worker thread back to the GUI thread.
+    '''
+    finished = pyqtSignal(object)
+
+class ImageJob(QRunnable):
+    '''
+    A decode or scale job running on the worker pool.
+    Superseded jobs are cancelled, the work checks the flag as it goes and the result of a cancelled job is dropped.
+    '''
+    def __init__(self, work):
+        super().__init__()
+        self.setAutoDelete(False) # The loader keeps the job alive until it's finished
+        self.work = work
+        self.cancelled = False
+        self.signals = JobSignals()
+
+    def run(self):
+        try:
+            result = self.work(self)
+        except Exception:
+            result = None
+        self.signals.finished.emit(result)
+
+class ImageLoader(QObject):
+    '''
+    Decodes and smoothly scales images on a pool of worker threads so the windows stay responsive while a big image loads.
+    The results are added to the image cache on the GUI thread and announced through signals.
+    '''
+    imageLoaded = pyqtSignal(str, bool) # Path of the image and whether it could be decoded
+    imageScaled = pyqtSignal(object, QSize, int) # Key of the image, the size and aspect mode it was scaled to
+    imageChanged = pyqtSignal(str, float) # Path of a cached image whose file changed on disk, the largest scale it was decoded at
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The loader shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.jobs = set() # Every job that's queued or running, so they stay alive until the pool is done with them
+        self.decodeJobs = {} # path -> (image key with the decode scale, job)
+        self.scaleJobs = {} # (image key, width, height, aspect mode) -> (group, owners waiting for it, job)
+        SourceFiles.instance().fileChanged.connect(self.onFileChanged)
+        if QCoreApplication.instance():
+            QCoreApplication.instance().aboutToQuit.connect(self.shutdown)
+
+    def requestImage(self, path, targetSize=None, scale=None, supersede=True):
+        '''
+        Decode the image at path in the background, at a scale large enough for targetSize or at full size if there's none,
+        or at the given decode scale. imageLoaded is emitted once it's in the image cache.
+        Decoding a new image, or the same one at a larger scale, cancels the ones that were requested before.
+        With supersede unset, e.g. to reload a changed file, only an older request for the same path is cancelled.
+        The file is read through the file layer, so it isn't read from disk again.
+        '''
+        key = ImageCache.imageKey(path)
+        if key is None:
+            self.imageLoaded.emit(path, False)
+            return
+
+        if scale is None:
+            scale = ImageCache.instance().decodeScale(path, targetSize)
+        if path in self.decodeJobs and self.decodeJobs[path][0][:2] == key and self.decodeJobs[path][0][2] >= scale:
+            return
+        for otherPath in list(self.decodeJobs):
+            if supersede or otherPath == path:
+                self.cancelJob(self.decodeJobs.pop(otherPath)[1])
+        key += (scale,)
+        reader = SourceFiles.instance().reader(path)
+
+        def decode(job):
+            cachedImage = ImageCache.decode(reader, key, job)
+            if cachedImage is None:
+                return None
+            return cachedImage, [ImageCache.buildPyramid(frame) for frame in cachedImage.frames]
+
+        job = self.startJob(decode, lambda job, result: self.onImageDecoded(path, job, result))
+        self.decodeJobs[path] = (key, job)
+
+    def onFileChanged(self, path):
+        '''
+        Drop the older versions of a file that changed on disk. If any were cached, imageChanged lets the main window
+        decode the new one once if it's shown, the windows pick it up from imageLoaded like any other decoded image.
+        '''
+        scale = ImageCache.instance().discard(path)
+        if scale is not None:
+            self.imageChanged.emit(path, scale)
+
+    def onImageDecoded(self, path, job, result):
+        if path not in self.decodeJobs or self.decodeJobs[path][1] is not job:
+            return # Superseded
+        del self.decodeJobs[path]
+        if result:
+            ImageCache.instance().addImage(*result)
+        self.imageLoaded.emit(path, result is not None)
+
+    def requestScale(self, cachedImage, size, aspectMode, frameIndexes=None, group='windows', owner=None):
+        '''
+        Smoothly scale the frames of an image in the background, imageScaled is emitted once they're in the image cache.
+        Windows of the same size share a request. A new request of an owner, e.g. a window or the preview, supersedes
+        its unfinished request for another size, which is cancelled unless another owner still waits for it.
+        '''
+        key = (cachedImage.key, size.width(), size.height(), aspectMode)
+        if owner is not None:
+            self.dropScaling(owner, key)
+        if key in self.scaleJobs:
+            self.scaleJobs[key][1].add(owner)
+            return
+
+        if frameIndexes is None:
+            frameIndexes = range(len(cachedImage.frames))
+        frames = [(frameIndex, cachedImage.frames[frameIndex]) for frameIndex in frameIndexes]
+
+        def scale(job):
+            scaledFrames = []
+            for frameIndex, frame in frames:
+                if job.cancelled:
+                    return None
+                scaledFrames.append((frameIndex, ImageCache.scaleFrame(frame, size, aspectMode)))
+            return scaledFrames
+
+        job = self.startJob(scale, lambda job, result: self.onImageScaled(cachedImage, size, aspectMode, key, job, result))
+        self.scaleJobs[key] = (group, {owner}, job)
+
+    def onImageScaled(self, cachedImage, size, aspectMode, key, job, result):
+        entry = self.scaleJobs.get(key)
+        if entry is None or entry[2] is not job:
+            return # Superseded
+        del self.scaleJobs[key]
+        if result is None:
+            return
+        for frameIndex, scaledFrame in result:
+            ImageCache.instance().addScaledFrame(cachedImage, frameIndex, size, aspectMode, scaledFrame)
+        self.imageScaled.emit(cachedImage.key, size, aspectMode)
+
+    def cancelScaling(self, group=None):
+        '''
+        Cancel the unfinished scale requests of a group, or all of them.
+        '''
+        for key, (jobGroup, owners, job) in list(self.scaleJobs.items()):
+            if group is None or jobGroup == group:
+                del self.scaleJobs[key]
+                self.cancelJob(job)
+
+    def dropScaling(self, owner, keepKey=None):
+        '''
+        Stop waiting for the unfinished scale requests of owner other than keepKey, e.g. once a window shows another size or closes.
+        Requests no other owner waits for are cancelled.
+        '''
+        for key, (group, owners, job) in list(self.scaleJobs.items()):
+            if key == keepKey or owner not in owners:
+                continue
+            owners.discard(owner)
+            if not owners:
+                del self.scaleJobs[key]
+                self.cancelJob(job)
+
+    def startJob(self, work, onFinished):
+        job = ImageJob(work)
+        job.signals.finished.connect(lambda result: self.onJobFinished(job, result, onFinished))
+        self.jobs.add(job)
+        self.pool.start(job)
+        return job
+
+    def onJobFinished(self, job, result, onFinished):
+        self.jobs.discard(job)
+        if not job.cancelled:
+            onFinished(job, result)
+
+    def shutdown(self):
+        '''
+        Cancel every job and wait for the running ones, so none of them finishes after the app has torn down its objects.
+        '''
+        for job in list(self.jobs):
+            self.cancelJob(job)
+        self.pool.waitForDone()
+
+    def cancelJob(self, job):
+        job.cancelled = True
+        if self.pool.tryTake(job): # Drop it right away if it hasn't started yet
+            self.jobs.discard(job)
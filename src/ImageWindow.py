@@ -1,8 +1,15 @@
+import math
+import time
 import random
-from PyQt5.QtWidgets import *
-from PyQt5.QtGui import *
-from PyQt5.QtGui import *
-from PyQt5.QtCore import *
+from PyQt5.QtWidgets import QApplication, QLabel, QMainWindow, QWIDGETSIZE_MAX
+from PyQt5.QtGui import QGuiApplication, QIcon, QPainter
+from PyQt5.QtCore import QEvent, QPoint, QRect, QRectF, Qt, pyqtSignal
+from ImageCache import ImageCache
+from AnimationClock import AnimationClock
+from ImageLoader import ImageLoader
+from Instrumentation import profiled
+from TileCache import TileCache
+from RefreshGovernor import RefreshGovernor
 
 class ImageWindow(QMainWindow):
     '''
@@ -10,6 +17,9 @@ class ImageWindow(QMainWindow):
     '''
     imageMoved = pyqtSignal(QPoint)  # Signals b/w windows when an image is moved
     windowClosing = pyqtSignal(object)  # Signals b/w windows when any window closes
+    needsSync = pyqtSignal()  # Signals the main window that the image positions have to be updated
+    visibilityChanged = pyqtSignal(bool)  # Signals when the window becomes visible or hidden, minimized or off-screen
+    geometryChanged = pyqtSignal(object)  # Signals the sync scheduler's geometry store when the window was moved or resized
 
     def __init__(self, parent=None, imagePath=None):
         '''
@@ -22,14 +32,51 @@ class ImageWindow(QMainWindow):
     def setMoveWithWindow(self, state):
         self.moveWithWindow = state    
 
+    def setSharedCanvas(self, state):
+        '''
+        Switch between showing a scaled copy of the image in the label and painting the shared source image straight into the window.
+        In the shared canvas mode the label is hidden and empty, it only keeps track of where the image is placed.
+        '''
+        if state == self.sharedCanvas:
+            return
+        self.sharedCanvas = state
+        self.canvasSource = None
+        self.imageLabel.clear()
+        self.imageLabel.setVisible(not state)
+        if self.image:
+            self.showFrame(self.frameIndex)
+        self.update()
+
+    def setFastTransform(self, state):
+        '''
+        Draw the shared canvas with fast instead of smooth transformation, e.g. while images are moved under load.
+        '''
+        if state == self.fastTransform:
+            return
+        self.fastTransform = state
+        if self.sharedCanvas:
+            self.update(self.imageTargetRect())
+
     def setKeepCentered(self, state):
-        self.keepCentered = state        
+        if state != self.keepCentered:
+            self.keepCentered = state
+            self.needsSync.emit()
     
     def initUI(self):
         '''
         The window is initialized randomly in a bounding box that's relative to the screen.
         The Image Label to hold the image is given the same size as the window.
         '''
+        self.setWindowIcon(QIcon('Files/logo.png'))
+        self.setWindowTitle('Image Window')
+        self.imageLabel = QLabel(self)
+        self.exposeFilterInstalled = False
+        self.placeRandomly()
+
+    def placeRandomly(self):
+        '''
+        Place the window randomly in a bounding box that's relative to the screen, with the label covering it.
+        '''
         screen = QApplication.primaryScreen().size()
         screenWidth = screen.width()
         screenHeight = screen.height()
@@ -37,42 +84,48 @@ class ImageWindow(QMainWindow):
         self.setGeometry(random.randint(screenWidth//4, screenWidth//2),
                          random.randint(0, screenHeight//2),
                          int(screenWidth//2.5), int(screenHeight//2))
-        
-        self.setWindowIcon(QIcon('Files/logo.png'))
-        self.setWindowTitle('Image Window')
-        self.imageLabel = QLabel(self)
         self.imageLabel.setGeometry(self.rect())
     
     def initSettings(self, imagePath):
         '''
-        The image path is assigned to the window as well as the update function to update the image position is initialized.
-        The settings from the main window are initialized as well.
+        The image path is assigned to the window and the settings from the main window are initialized as well.
+        The image position is kept up to date by the sync scheduler of the main window.
         '''
         self.currentImagePath = imagePath
-        self.movie = None
+        self.image = None # Decoded frames shared through the image cache
+        self.frameIndex = 0
+        self.initScale = None
+        self.scaleFactor = 1
+        self.scaledSize = None
+        self.smoothScale = True
+        self.fastTransform = False # Set by the refresh governor under load
+        self.sharedCanvas = False
+        self.canvasSource = None # Unscaled frame shared by all the windows, painted in the shared canvas mode
+        
+        ImageLoader.instance().imageLoaded.connect(self.onImageLoaded)
+        ImageLoader.instance().imageScaled.connect(self.onImageScaled)
+        TileCache.instance().tileReady.connect(self.onTileReady)
         
         self.moveWithWindow = False
         self.keepCentered = False
+        self.isImageMoved = False # Flag to check if the image window has been moved
+        self.isShown = False # Whether the window can be seen at all, hidden windows skip the animation and position updates
+        self.isReleased = False
         
-        if imagePath:
-            self.loadImage(imagePath, 1)        
-        self.updateFunction(1)
+        QGuiApplication.instance().screenAdded.connect(self.updateVisibility)
+        QGuiApplication.instance().screenRemoved.connect(self.updateVisibility)
         
-    def updateFunction(self, timeStep):
-        '''
-        A timer to keep track and update the image's position until the window is moved.
-        timeStep determines how often the update function is called and can be controlled by radio buttons in the main window.
-        '''
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.updateImagePosition)
-        self.timer.start(timeStep)    
-        self.isImageMoved = False # Flag to check if the image window has been moved
+        if imagePath:
+            self.loadImage(imagePath, 1)
 
     def moveEvent(self, event):
         '''
         Override the default move event to communicate the positon between different windows when an Image window is moved.
         It ensures that image remains at a consistent position relative to the other windows.
         '''
+        self.updateVisibility()
+        self.geometryChanged.emit(self)
+        self.needsSync.emit()
         if not self.moveWithWindow: # Return if 'Move With Window' has not been checked in the main window
             return
         super().moveEvent(event)
@@ -81,92 +134,354 @@ class ImageWindow(QMainWindow):
             self.imageMoved.emit(globalPos)  # Communicate the image position to different windows
             self.isImageMoved = True # Indicated that window has been moved manually
 
+    def resizeEvent(self, event):
+        '''
+        A resized window changes the image positions if it's the reference window or the image has to be kept centered.
+        '''
+        super().resizeEvent(event)
+        self.updateVisibility()
+        self.geometryChanged.emit(self)
+        self.needsSync.emit()
+
+    def event(self, event):
+        '''
+        Report how long repainting the window took to the refresh governor, painting the label included.
+        '''
+        if event.type() != QEvent.UpdateRequest or RefreshGovernor.current is None:
+            return super().event(event)
+        start = time.perf_counter()
+        result = super().event(event)
+        RefreshGovernor.recordRepaint(time.perf_counter() - start)
+        return result
+
+    def changeEvent(self, event):
+        '''
+        Activating a window can change the reference window when 'Keep Centered' is checked.
+        Minimizing or restoring it changes whether it can be seen.
+        '''
+        super().changeEvent(event)
+        if event.type() == QEvent.ActivationChange:
+            self.needsSync.emit()
+        elif event.type() == QEvent.WindowStateChange:
+            self.updateVisibility()
+
+    def showEvent(self, event):
+        '''
+        Start tracking the exposure of the native window, e.g. some platforms unexpose fully covered windows.
+        '''
+        super().showEvent(event)
+        if self.windowHandle() and not self.exposeFilterInstalled:
+            self.windowHandle().installEventFilter(self)
+            self.exposeFilterInstalled = True
+        self.updateVisibility()
+        self.geometryChanged.emit(self)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.updateVisibility()
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Expose and obj is self.windowHandle():
+            self.updateVisibility()
+        return super().eventFilter(obj, event)
+
+    def isOnScreen(self):
+        '''
+        Whether the window intersects any of the screens that are connected.
+        '''
+        frame = self.frameGeometry()
+        return any(screen.geometry().intersects(frame) for screen in QGuiApplication.screens())
+
+    def updateVisibility(self):
+        '''
+        Track whether the window can be seen. Hidden, minimized, unexposed and off-screen windows pause their
+        animation and position updates, and resync in one step once they can be seen again.
+        '''
+        windowHandle = self.windowHandle()
+        isShown = (self.isVisible() and not self.isMinimized() and self.isOnScreen()
+                   and (windowHandle is None or windowHandle.isExposed()))
+        if isShown == self.isShown:
+            return
+        
+        self.isShown = isShown
+        if isShown:
+            self.resync()
+        else:
+            AnimationClock.instance().leave(self)
+        self.visibilityChanged.emit(isShown)
+
+    def resync(self):
+        '''
+        Catch up with everything that was skipped while the window was hidden.
+        The GIF jumps to the frame the other windows are showing and the image is realigned to the reference window.
+        '''
+        if self.image and self.image.isAnimated:
+            AnimationClock.instance().join(self, self.image)
+        self.isImageMoved = False
+        self.needsSync.emit()
+
+    @profiled
     def loadImage(self, imagePath, scaleFactor):
         '''
         Load the Image/GIF into the window and apply the scaleFactor.
-        Decides between QMovie and QPixmap based on the type of image.
-        If .gif it uses QMovie, else QPixmap.
+        The decoded frames come from the shared image cache, so the file is decoded once for all the windows.
+        The image is decoded straight at the resolution the window needs. If it isn't decoded at that resolution yet,
+        a smaller version or a placeholder is shown until the image loader has decoded it in the background.
+        GIFs are stretched to the scaled window size like QMovie does, other images keep their aspect ratio.
         '''
         self.currentImagePath = imagePath
-        if imagePath.lower().endswith('.gif'): 
-            self.movie = QMovie(imagePath)
-            self.movie.setScaledSize(self.imageLabel.size() * scaleFactor)             
-            self.imageLabel.setMovie(self.movie)
-            self.movie.start()  
-            self.initScale = self.imageLabel.size() # Storing intial scale
-        else:
-            self.movie = None
-            pixmap = QPixmap(imagePath)
-            if not pixmap.isNull(): 
-                scaledPixmap = pixmap.scaled(self.size() * scaleFactor, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                self.imageLabel.setPixmap(scaledPixmap)
-            self.initScale = self.size() # Storing initial scale
+        self.scaleFactor = scaleFactor
+        targetSize = self.size() * scaleFactor
+        self.image = ImageCache.instance().cachedImage(imagePath, targetSize, allowSmaller=True)
+        self.frameIndex = 0
+        AnimationClock.instance().leave(self)
+        if not self.image or self.image.decodeScale < ImageCache.instance().decodeScale(imagePath, targetSize):
+            ImageLoader.instance().requestImage(imagePath, targetSize)
+        if not self.image:
+            self.imageLabel.setText('Loading...') # Cheap placeholder
+            return
+
+        self.aspectMode = Qt.IgnoreAspectRatio if self.image.isAnimated else Qt.KeepAspectRatio
+        self.initScale = self.size() # Storing initial scale
+        self.setScale(scaleFactor)
+        if self.image.isAnimated and self.isShown:
+            AnimationClock.instance().join(self, self.image) # Starts at the frame the other windows are showing
+
+    @profiled
+    def showFrame(self, frameIndex):
+        '''
+        Show a frame of the current image at the current scale.
+        For GIFs it's called by the animation clock, which keeps all the windows on the same frame.
+        GIF frames come from the frame stream of the animation, shared by all the windows showing the GIF at the same size.
+        Until the smoothly scaled frames arrive from the image loader or the stream, a quick approximation is shown.
+        '''
+        self.frameIndex = frameIndex
+        cache = ImageCache.instance()
+        stream = AnimationClock.instance().stream(self) if self.image.isAnimated else None
+        if stream:
+            pixmap = stream.frame(frameIndex, None if self.sharedCanvas else self.scaledSize, self.aspectMode, self.smoothScale)
+            if pixmap is None:
+                return # Not decoded yet, the previous frame stays until the stream catches up
+            if self.sharedCanvas:
+                self.canvasSource = pixmap
+                self.update(self.imageTargetRect())
+            else:
+                self.imageLabel.setPixmap(pixmap)
+            return
+        if frameIndex >= len(self.image.frames):
+            return # Only the first frame of a GIF is cached, the others are streamed while it plays
+
+        if self.sharedCanvas:
+            self.canvasSource = cache.pixmap(self.image, frameIndex) # The same pixmap for every window, no scaled copies
+            self.update(self.imageTargetRect())
+            return
+        
+        pixmap = None
+        if self.smoothScale:
+            pixmap = cache.scaledPixmap(self.image, frameIndex, self.scaledSize, self.aspectMode)
+            if pixmap is None:
+                ImageLoader.instance().requestScale(self.image, self.scaledSize, self.aspectMode, owner=self)
+        if pixmap is None:
+            pixmap = cache.pixmap(self.image, frameIndex, self.scaledSize, self.aspectMode, smooth=False)
+        self.imageLabel.setPixmap(pixmap)
+
+    def onImageLoaded(self, imagePath, loaded):
+        '''
+        Show the image once the image loader has decoded it, if it's still the one this window should show
+        and it's a better fit than the version that's shown now.
+        '''
+        if imagePath != self.currentImagePath or not self.isVisible():
+            return
+        if not loaded:
+            if not self.image:
+                self.imageLabel.clear()
+            return
+        
+        if self.image is not ImageCache.instance().cachedImage(imagePath, self.size() * self.scaleFactor, allowSmaller=True):
+            self.loadImage(imagePath, self.scaleFactor)
+
+    def onImageScaled(self, imageKey, size, aspectMode):
+        '''
+        Replace the quick approximation with the smoothly scaled frame once the image loader is done with it.
+        '''
+        if self.image and self.image.key == imageKey and size == self.scaledSize and aspectMode == self.aspectMode and self.smoothScale:
+            self.showFrame(self.frameIndex)
 
     def centerImage(self):
         '''
         Move the image/GIF to the center of the window.
+        Returns True if the image had to be moved.
         '''
-        if self.movie: 
-            rect = QRect(0, 0, self.movie.scaledSize().width(), self.movie.scaledSize().height())
-        elif self.imageLabel.pixmap() and not self.imageLabel.pixmap().isNull():
-            pixmap = self.imageLabel.pixmap()
-            rect = pixmap.rect()
-        else:
-            return 
+        size = self.displayedImageSize()
+        if size is None:
+            return False
+        rect = QRect(QPoint(0, 0), size)
 
         rect.moveCenter(self.rect().center())
-        self.imageLabel.setGeometry(rect)
-    
-    def updateImagePosition(self): 
+        return self.moveImage(rect.topLeft())
+
+    def displayedImageSize(self):
+        '''
+        Size the image is shown at, None if there's no image.
         '''
-        Used to update the position of image ensuring that the image remains  at a consistent position relative to the other windows.
-        If the user has "Keep Centered" checked it aligns the images of the active window to the center and aligns images of other windows around it. 
+        if self.sharedCanvas:
+            return self.image.size().scaled(self.scaledSize, self.aspectMode) if self.image and self.scaledSize else None
+        pixmap = self.imageLabel.pixmap()
+        if not pixmap or pixmap.isNull():
+            return None
+        return pixmap.size()
+
+    def imageTargetRect(self):
         '''
-        if self.isImageMoved: # Skip if window was moved, then moveEvent governs the image position            
+        Rect in window coordinates the image covers in the shared canvas mode.
+        It's placed within the label's geometry the same way the label shows its pixmap, left aligned and vertically centered.
+        '''
+        size = self.displayedImageSize()
+        if size is None:
+            return QRect()
+        label = self.imageLabel.geometry()
+        return QRect(QPoint(label.x(), label.y() + (label.height() - size.height()) // 2), size)
+
+    def paintEvent(self, event):
+        '''
+        In the shared canvas mode paint the part of the shared source image that lines up with this window.
+        Only the visible part is drawn, so the cost is proportional to the area of the window rather than the scaled image.
+        For images too large to be decoded as a whole, the tiles overlapping the visible part are drawn over the overview once they're decoded.
+        '''
+        super().paintEvent(event)
+        if not self.sharedCanvas or not self.canvasSource:
             return
 
-        if self.currentImagePath:
-            activeWindow = QApplication.activeWindow()
-
-            if self == activeWindow and self.keepCentered:
-                self.centerImage()
-                return
-
-            if self.parent().imageWindows:
-                if isinstance(activeWindow, ImageWindow) and self.keepCentered: 
-                    refWindow = activeWindow #  Active window is the one that's selected and it governs the image positions
-                else:
-                    refWindow = self.parent().imageWindows[0] # If no window has been selected the first one governs the image positions
-                globalPos = refWindow.mapToGlobal(refWindow.imageLabel.pos())
-                localPos = self.mapFromGlobal(globalPos)
-                self.imageLabel.move(localPos)
-                self.update()
-        
-                
-    def restartGif(self):
-        '''Used to sync the GIF animation across all windows.'''
-        if self.currentImagePath and self.currentImagePath.lower().endswith('.gif'):
-            if self.movie:
-                self.movie.stop()
-                self.movie.start()
+        target = self.imageTargetRect()
+        visible = target.intersected(event.rect())
+        if visible.isEmpty():
+            return
+
+        scaleX = self.canvasSource.width() / target.width()
+        scaleY = self.canvasSource.height() / target.height()
+        sourceRect = QRectF((visible.x() - target.x()) * scaleX, (visible.y() - target.y()) * scaleY,
+                            visible.width() * scaleX, visible.height() * scaleY)
+
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, self.smoothScale and not self.fastTransform)
+        painter.drawPixmap(QRectF(visible), self.canvasSource, sourceRect)
+
+        cache = ImageCache.instance()
+        if cache.isTiled(self.image):
+            fullSize = cache.header(self.image.key[:2])[0]
+            scale = target.width() / fullSize.width()
+            if scale > self.image.decodeScale: # The overview isn't detailed enough
+                self.paintTiles(painter, target, visible, fullSize, scale)
+
+    def paintTiles(self, painter, target, visible, fullSize, scale):
+        '''
+        Draw the tiles of the level closest to scale that overlap the visible part of the image.
+        '''
+        level = TileCache.levelFor(scale)
+        factor = level / scale # Pixels of the level per pixel of the window
+        levelRect = QRect(math.floor((visible.x() - target.x()) * factor), math.floor((visible.y() - target.y()) * factor),
+                          math.ceil(visible.width() * factor) + 1, math.ceil(visible.height() * factor) + 1)
+
+        painter.setClipRect(visible)
+        for tileRect, pixmap in TileCache.instance().tilesFor(self.image.key[:2], fullSize, level, levelRect):
+            if pixmap:
+                targetRect = QRectF(target.x() + tileRect.x() / factor, target.y() + tileRect.y() / factor,
+                                    tileRect.width() / factor, tileRect.height() / factor)
+                painter.drawPixmap(targetRect, pixmap, QRectF(pixmap.rect()))
+
+    def onTileReady(self, imageKey):
+        '''
+        Repaint once a tile of the shown image has been decoded.
+        '''
+        if self.sharedCanvas and self.isShown and self.image and self.image.key[:2] == imageKey:
+            self.update(self.imageTargetRect())
+    
+    def imageGlobalPos(self):
+        '''
+        Position of the image in global coordinates, used as the reference for the images in the other windows.
+        '''
+        return self.mapToGlobal(self.imageLabel.pos())
+
+    @profiled
+    def moveImage(self, localPos):
+        '''
+        Move the image to localPos in window coordinates, the label is only touched if it actually moves.
+        Moving the label repaints the area it covers, so no forced update of the window is needed.
+        Returns True if the image had to be moved.
+        '''
+        if localPos == self.imageLabel.pos():
+            return False
+        if self.sharedCanvas:
+            oldRect = self.imageTargetRect()
+            self.imageLabel.move(localPos)
+            self.update(oldRect.united(self.imageTargetRect()))
+        else:
+            self.imageLabel.move(localPos)
+        return True
                 
-    def setScale(self, scaleFactor):
+    @profiled
+    def setScale(self, scaleFactor, smooth=True):
         '''
         Scale the image and its label based on the user input by using the scale slider.
+        The decoded image stays in memory, only the scaled pixmap has to be made.
+        With smooth unset, e.g. while the slider is dragged, a quick approximation from the scale pyramid is shown instead.
         '''
-        if self.movie and self.initScale:
-            newSize = self.initScale * scaleFactor
-            self.movie.setScaledSize(newSize)
-        elif self.imageLabel.pixmap() and not self.imageLabel.pixmap().isNull() and self.initScale:
-            newSize = self.initScale * scaleFactor
-            scaledPixmap = QPixmap(self.currentImagePath).scaled(newSize, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.imageLabel.setPixmap(scaledPixmap)
-        self.imageLabel.setFixedSize(newSize)
+        self.scaleFactor = scaleFactor
+        if not self.image or not self.initScale:
+            return
+        self.smoothScale = smooth
+        oldRect = self.imageTargetRect()
+        self.scaledSize = self.initScale * scaleFactor
+        if smooth and self.image.decodeScale < ImageCache.instance().decodeScale(self.currentImagePath, self.scaledSize):
+            ImageLoader.instance().requestImage(self.currentImagePath, self.scaledSize) # Decoded at a too small resolution
+        self.showFrame(self.frameIndex)
+        self.imageLabel.setFixedSize(self.scaledSize)
         self.imageLabel.adjustSize()
+        if self.sharedCanvas:
+            self.update(oldRect.united(self.imageTargetRect()))
         
     def closeEvent(self, event):
         '''
         Communicate to the main window that one image has been closed to remove it from the list of the imageWindows.
+        Everything the window holds on to is released afterwards, so a closed window doesn't do any work or keep any pixmaps.
+        '''
+        AnimationClock.instance().leave(self)
+        self.windowClosing.emit(self)
+        self.releaseResources()
+        super().closeEvent(event)
+
+    def releaseResources(self):
+        '''
+        Leave the animation, drop its scale requests, disconnect from the image loader, the tile cache and the screens,
+        drop the connections of the window's own signals and clear its pixmaps.
+        '''
+        if self.isReleased:
+            return
+        self.isReleased = True
+        AnimationClock.instance().leave(self)
+        ImageLoader.instance().dropScaling(self)
+        ImageLoader.instance().imageLoaded.disconnect(self.onImageLoaded)
+        ImageLoader.instance().imageScaled.disconnect(self.onImageScaled)
+        TileCache.instance().tileReady.disconnect(self.onTileReady)
+        QGuiApplication.instance().screenAdded.disconnect(self.updateVisibility)
+        QGuiApplication.instance().screenRemoved.disconnect(self.updateVisibility)
+        for signal in (self.imageMoved, self.windowClosing, self.needsSync, self.visibilityChanged, self.geometryChanged):
+            try:
+                signal.disconnect()
+            except TypeError: # Nothing connected
+                pass
+        self.imageLabel.clear()
+        self.image = None
+        self.canvasSource = None
+        self.scaledSize = None
+        self.currentImagePath = None
+
+    def reuse(self, imagePath=None):
+        '''
+        Reset a closed window to the state of a new one, used by the window pool.
         '''
-        self.windowClosing.emit(self) 
-        super().closeEvent(event)
\ No newline at end of file
+        self.imageLabel.setMinimumSize(0, 0) # Undo the fixed size of the last scale
+        self.imageLabel.setMaximumSize(QWIDGETSIZE_MAX, QWIDGETSIZE_MAX)
+        self.imageLabel.setVisible(True)
+        self.placeRandomly()
+        self.initSettings(imagePath)
\ No newline at end of file
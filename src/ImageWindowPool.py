@@ -0,0 +1,39 @@
+from ImageWindow import ImageWindow
+
+class ImageWindowPool:
+    '''
+    Keeps closed image windows to show them again, so reopening many windows doesn't create them from scratch.
+    Windows release their resources when they're closed and are reset when they're reused.
+    Windows closed while the pool is full are deleted.
+    '''
+    CAPACITY = 99 # The most windows the main window opens at once
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.windows = [] # Closed windows ready to be reused
+
+    def acquire(self, imagePath=None):
+        '''
+        A closed window reset to the state of a new one, or a new window if there's none.
+        '''
+        if self.windows:
+            window = self.windows.pop()
+            window.reuse(imagePath)
+            return window
+        return ImageWindow(self.parent, imagePath)
+
+    def release(self, window):
+        '''
+        Take back a window that was closed.
+        '''
+        if window in self.windows:
+            return
+        if len(self.windows) < self.CAPACITY:
+            self.windows.append(window)
+        else:
+            window.deleteLater()
+
+    def clear(self):
+        for window in self.windows:
+            window.deleteLater()
+        self.windows.clear()
@@ -0,0 +1,193 @@
+import json
+import time
+import functools
+from PyQt5.QtCore import QElapsedTimer, QObject, QTimer, Qt, pyqtSignal
+
+def profiled(func):
+    '''
+    Record the call count and latency of a hot path method while the instrumentation is enabled.
+    When it's disabled the only overhead is a single attribute check.
+    '''
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not Instrumentation.enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Instrumentation.instance().record(name, time.perf_counter() - start)
+    return wrapper
+
+class LagProbe(QObject):
+    '''
+    Measures the latency of the event loop by checking how late a short timer fires.
+    '''
+    INTERVAL = 10 # In ms
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.lags = []
+        self.elapsed = QElapsedTimer()
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.onTimeout)
+
+    def start(self):
+        self.lags = []
+        self.elapsed.start()
+        self.timer.start(self.INTERVAL)
+
+    def stop(self):
+        self.timer.stop()
+
+    def onTimeout(self):
+        self.lags.append(max(0, self.elapsed.restart() - self.INTERVAL))
+
+    def summary(self):
+        if not self.lags:
+            return {'mean': 0, 'p95': 0, 'max': 0}
+        lags = sorted(self.lags)
+        return {'mean': round(sum(lags) / len(lags), 2),
+                'p95': lags[int(len(lags) * 0.95)],
+                'max': lags[-1]}
+
+class Histogram:
+    '''
+    Call count and latency distribution of a single method, bucketed in powers of two microseconds.
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0 # In seconds
+        self.max = 0.0
+        self.buckets = {} # Upper bound in us -> count
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = 1 << int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        '''
+        Upper bound in ms of the bucket the given fraction of the calls falls into.
+        '''
+        remaining = self.calls * fraction
+        for bucket in sorted(self.buckets):
+            remaining -= self.buckets[bucket]
+            if remaining <= 0:
+                return bucket / 1000
+        return 0
+
+    def toDict(self):
+        return {'calls': self.calls,
+                'totalMs': round(self.total * 1000, 3),
+                'meanMs': round(self.total * 1000 / self.calls, 4) if self.calls else 0,
+                'maxMs': round(self.max * 1000, 3),
+                'p95Ms': self.percentile(0.95),
+                'histogramUs': {str(bucket): count for bucket, count in sorted(self.buckets.items())}}
+
+class Instrumentation(QObject):
+    '''
+    Opt-in recording of where the time goes: latency histograms of the hot paths, timer wakeups and the event loop lag.
+    Everything is off by default, the hot paths only check the enabled flag until it's switched on.
+    '''
+    REPORT_INTERVAL = 1000 # In ms
+    updated = pyqtSignal(str) # One line summary of the last interval, e.g. for the status bar
+
+    enabled = False
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The instrumentation shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def countWakeup(cls, timerName):
+        '''
+        Count a wakeup of one of the app's timers.
+        '''
+        if cls.enabled:
+            instance = cls.instance()
+            instance.wakeups[timerName] = instance.wakeups.get(timerName, 0) + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.lagProbe = LagProbe(self)
+        self.reportTimer = QTimer(self)
+        self.reportTimer.timeout.connect(self.report)
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+        self.wakeups = {}
+        self.lastCalls = {}
+        self.lastWakeups = {}
+        self.lagHistogram = Histogram()
+        self.started = time.perf_counter()
+
+    def setEnabled(self, enabled):
+        '''
+        Start or stop recording. Starting again resets the recorded data.
+        '''
+        if enabled == Instrumentation.enabled:
+            return
+        Instrumentation.enabled = enabled
+        if enabled:
+            self.reset()
+            self.lagProbe.start()
+            self.reportTimer.start(self.REPORT_INTERVAL)
+        else:
+            self.lagProbe.stop()
+            self.reportTimer.stop()
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def report(self):
+        '''
+        Fold the lag measured since the last report into its histogram and summarize the last interval.
+        '''
+        for lag in self.lagProbe.lags:
+            self.lagHistogram.add(lag / 1000)
+        lag = self.lagProbe.summary()
+        self.lagProbe.lags = []
+
+        seconds = self.REPORT_INTERVAL / 1000
+        parts = []
+        for name, histogram in sorted(self.histograms.items()):
+            calls = histogram.calls - self.lastCalls.get(name, 0)
+            self.lastCalls[name] = histogram.calls
+            if calls:
+                parts.append('{} {:.0f}/s p95 {}ms'.format(name.split('.')[-1], calls / seconds, histogram.percentile(0.95)))
+        wakeups = sum(self.wakeups.values()) - sum(self.lastWakeups.values())
+        self.lastWakeups = dict(self.wakeups)
+        parts.append('wakeups {:.0f}/s'.format(wakeups / seconds))
+        parts.append('lag p95 {}ms'.format(lag['p95']))
+        self.updated.emit(' | '.join(parts))
+
+    def snapshot(self):
+        '''
+        All the data recorded so far.
+        '''
+        duration = time.perf_counter() - self.started
+        return {'duration': round(duration, 3),
+                'methods': {name: histogram.toDict() for name, histogram in sorted(self.histograms.items())},
+                'timerWakeups': dict(self.wakeups),
+                'timerWakeupsPerSecond': {name: round(count / duration, 2) for name, count in self.wakeups.items()} if duration else {},
+                'eventLoopLag': self.lagHistogram.toDict()}
+
+    def export(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
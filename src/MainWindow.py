@@ -1,23 +1,46 @@
 import random
-from fileinput import filename
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
+from PyQt5.QtWidgets import QAction, QApplication, QCheckBox, QFileDialog, QHBoxLayout, QLabel, QLayout, QLineEdit, QMainWindow, QMessageBox, QPushButton, QRadioButton, QSlider, QStatusBar, QToolBar, QVBoxLayout, QWidget
+from PyQt5.QtCore import QEvent, QTimer, Qt, pyqtSignal
+from PyQt5.QtGui import QIcon, QIntValidator
 from ImageWindow import ImageWindow
+from ImageWindowPool import ImageWindowPool
+from SyncScheduler import SyncScheduler
+from RefreshGovernor import RefreshGovernor
+from ImageCache import ImageCache
+from ImageLoader import ImageLoader
+from Instrumentation import Instrumentation, profiled
 
 class MainWindow(QMainWindow):
     '''
     This class manages all the image windows and governs various settings, window count, and the image to be applied on the image windows.
     '''
+    BATCH_SIZE = 5 # Number of windows created per turn of the event loop when opening multiple windows
+    windowsOpened = pyqtSignal(int) # Signals when a batch of windows has been opened
+    firstPainted = pyqtSignal() # Signals when the main window has been painted for the first time
+    startupFinished = pyqtSignal() # Signals when the work deferred until after the first paint is done
+    
     def __init__(self):
         '''
         Initialize the UI of the window, assign the default path of the images, and intialize an array to store all the image windows.
         '''
         super().__init__()        
         self.imageWindows = []        
+        self.windowsToOpen = 0 # Windows still to be created by the running batch
+        self.windowGeometries = [] # Geometries for the next windows to be created, e.g. when a session is restored
         self.currentImagePath = 'Files/tess.gif'
+        self.multiProcess = False # Whether new windows are hosted by worker processes
+        self.hostPool = None # Started once the first window is hosted by a worker process
+        self.windowPool = ImageWindowPool(self) # Closed windows to be shown again
+        self.isPainted = False
+        self.syncScheduler = SyncScheduler(self.imageWindows, self) # Single timer that keeps all the image positions in sync
+        self.refreshGovernor = RefreshGovernor(self.syncScheduler, self.imageWindows, self) # Drives the 'Auto' refresh rate
+        self.refreshGovernor.levelChanged.connect(self.onQualityLevelChanged)
         self.initUI()
         
+        ImageLoader.instance().imageLoaded.connect(self.onImageLoaded)
+        ImageLoader.instance().imageScaled.connect(self.onImageScaled)
+        ImageLoader.instance().imageChanged.connect(self.onImageChanged)
+        
     def initUI(self):
         '''
         Initialize the window settings, layout and the UI components.
@@ -26,6 +49,26 @@ class MainWindow(QMainWindow):
         self.initLayout()
         self.initComponents()       
         
+    def event(self, event):
+        '''
+        Finish the startup once the window has been painted for the first time, so nothing delays the first frame.
+        '''
+        result = super().event(event)
+        if event.type() == QEvent.Paint and not self.isPainted:
+            self.isPainted = True
+            self.firstPainted.emit()
+            QTimer.singleShot(0, self.finishStartup)
+        return result
+        
+    def finishStartup(self):
+        '''
+        Work that isn't needed for the first frame: the icons and the preview of the default image, which is decoded in the background.
+        '''
+        self.setWindowIcon(QIcon('Files/logo.png'))
+        self.randomizeAction.setIcon(QIcon('Files/randomize.png'))
+        self.displayImagePreview()
+        self.startupFinished.emit()
+        
     def initWindow(self):
         '''
         The main window settings and properties are assigned here.
@@ -37,8 +80,7 @@ class MainWindow(QMainWindow):
         
         self.move(self.screenWidth // 10, self.screenHeight // 10)
         
-        self.setWindowIcon(QIcon('Files/logo.png'))
-        self.setWindowTitle('Image Window Manager')
+        self.setWindowTitle('Image Window Manager') # The icon is loaded after the first paint
         
     def initLayout(self):
         '''
@@ -88,6 +130,28 @@ class MainWindow(QMainWindow):
         closeAllAction.triggered.connect(self.closeAllImageWindows)
         fileMenu.addAction(closeAllAction)
         
+        saveSessionAction = QAction('&Save Session', self)
+        saveSessionAction.triggered.connect(self.saveSession)
+        fileMenu.addAction(saveSessionAction)
+        
+        restoreSessionAction = QAction('&Restore Session', self)
+        restoreSessionAction.triggered.connect(self.restoreSession)
+        fileMenu.addAction(restoreSessionAction)
+        
+        perfMenu = menuBar.addMenu('&Performance')
+        
+        recordAction = QAction('&Record Performance', self, checkable=True)
+        recordAction.toggled.connect(self.setInstrumentationEnabled)
+        perfMenu.addAction(recordAction)
+        
+        exportAction = QAction('&Export Performance Data', self)
+        exportAction.triggered.connect(self.exportPerformanceData)
+        perfMenu.addAction(exportAction)
+        
+        multiProcessAction = QAction('&Host Windows in Worker Processes', self, checkable=True)
+        multiProcessAction.toggled.connect(self.setMultiProcess)
+        perfMenu.addAction(multiProcessAction)
+        
     def initStatusBar(self):
         '''
         Initalize a Status Bar to message about display different operations in the bottom of the screen.
@@ -96,6 +160,11 @@ class MainWindow(QMainWindow):
         self.setStatusBar(self.statusBar)
         self.statusBar.showMessage('Open a new window!', 5000)
         
+        self.perfLabel = QLabel() # Live performance overlay, only shown while recording
+        self.perfLabel.hide()
+        self.statusBar.addPermanentWidget(self.perfLabel)
+        Instrumentation.instance().updated.connect(self.perfLabel.setText)
+        
     def initToolBar(self):
         '''
         Initialize a Tool Bar with options to randomize the settings and open multiple windows based on the number of window specified.
@@ -103,9 +172,9 @@ class MainWindow(QMainWindow):
         toolBar = QToolBar('Tool Bar', self)
         self.addToolBar(Qt.TopToolBarArea, toolBar)
         
-        randomizeAction = QAction(QIcon('Files/randomize.png'), 'Randomize', self)
-        randomizeAction.triggered.connect(self.randomizeSettings)
-        toolBar.addAction(randomizeAction)
+        self.randomizeAction = QAction('Randomize', self) # The icon is loaded after the first paint
+        self.randomizeAction.triggered.connect(self.randomizeSettings)
+        toolBar.addAction(self.randomizeAction)
         
         self.numWindowsInput = QLineEdit(self)
         self.numWindowsInput.setValidator(QIntValidator(1, 99))
@@ -121,6 +190,7 @@ class MainWindow(QMainWindow):
         '''
         Initialize a Slider for scaling the image.
         The values are scaled 100 folds to enable fine control and each step for a slider is an integer.
+        While the slider moves the windows get a quick approximate scale, the smooth one is applied once it's released or idle.
         '''
         self.scaleLabel = QLabel('Scale Image')
         self.scaleSlider = QSlider(Qt.Horizontal)
@@ -128,7 +198,13 @@ class MainWindow(QMainWindow):
         self.scaleSlider.setFixedSize(self.screenWidth // 15, self.screenHeight // 50)
         self.scaleSlider.setRange(25, 400) # Represents .25 to 4
         self.scaleSlider.setValue(100)  # Represents 1
-        self.scaleSlider.valueChanged.connect(self.updateImageScale)
+        self.scaleSlider.valueChanged.connect(self.onScaleSliderMoved)
+        
+        self.scaleIdleTimer = QTimer(self) # Applies the smooth scale once the slider stops moving
+        self.scaleIdleTimer.setSingleShot(True)
+        self.scaleIdleTimer.setInterval(200)
+        self.scaleIdleTimer.timeout.connect(self.updateImageScale)
+        self.scaleSlider.sliderReleased.connect(self.scaleIdleTimer.start)
         
         self.leftLayout.addWidget(self.scaleLabel)
         self.leftLayout.addWidget(self.scaleSlider)
@@ -140,33 +216,44 @@ class MainWindow(QMainWindow):
         self.imageSettLabel = QLabel('Image Settings')
         self.moveWWindowCb = QCheckBox('Move with window')
         self.keepCenteredCb = QCheckBox('Keep Centered')
+        self.sharedCanvasCb = QCheckBox('Shared Canvas') # Paint the shared image instead of a scaled copy per window
         
         self.leftLayout.addWidget(self.imageSettLabel)
         self.leftLayout.addWidget(self.moveWWindowCb)
         self.leftLayout.addWidget(self.keepCenteredCb)   
+        self.leftLayout.addWidget(self.sharedCanvasCb)
         
         self.moveWWindowCb.clicked.connect(self.updateImageSettings)
         self.keepCenteredCb.clicked.connect(self.updateImageSettings)
+        self.sharedCanvasCb.clicked.connect(self.updateImageSettings)
         self.moveWWindowCb.setChecked(True) # Default
         
     def initRadioBtns(self):
         '''
         Initialize radio buttons to control the refresh rate of the update function of Image Windows.
+        'On Change' doesn't poll at all and only updates the image positions when a window is moved, resized or activated.
+        'Auto' adapts the refresh rate and the quality to the load.
         '''
         self.refreshRateLabel = QLabel('Refresh Rate')
         self.slowR = QRadioButton('Slow')
         self.medR = QRadioButton('Medium')
         self.fastR = QRadioButton('Fast')
+        self.eventR = QRadioButton('On Change')
+        self.autoR = QRadioButton('Auto')
         self.fastR.setChecked(True) # Default
         
         self.slowR.clicked.connect(self.updateTimeStep)
         self.medR.clicked.connect(self.updateTimeStep)
         self.fastR.clicked.connect(self.updateTimeStep)       
+        self.eventR.clicked.connect(self.updateTimeStep)
+        self.autoR.clicked.connect(self.updateTimeStep)
 
         self.leftLayout.addWidget(self.refreshRateLabel)
         self.leftLayout.addWidget(self.slowR)
         self.leftLayout.addWidget(self.medR)
         self.leftLayout.addWidget(self.fastR)
+        self.leftLayout.addWidget(self.eventR)
+        self.leftLayout.addWidget(self.autoR)
         
     def initImageDisplay(self):
         '''
@@ -217,59 +304,146 @@ class MainWindow(QMainWindow):
         
         for window in self.imageWindows:
             window.loadImage(self.currentImagePath, self.scaleSlider.value() / 100) # Scale = 1
+            
+        self.syncScheduler.wake()
 
     def openNewWindow(self):
         '''
         Opens a new image window as a child of the main window.
-        Connects signals for image position and window closing.
         '''
-        newWindow = ImageWindow(self)
+        self.createImageWindow()
+        
+        self.statusBar.showMessage('Opened new window', 3000) # GIFs are kept in sync by the animation clock
+            
+        self.displayImagePreview()
+        
+        self.updateAllSettings()
+
+    def createImageWindow(self):
+        '''
+        Creates and shows a single image window showing the current image.
+        Connects signals for image position and window closing.
+        In the multi-process mode the window is hosted by a worker process and a stand-in with the same signals is returned.
+        Windows are placed randomly unless a geometry is queued for them.
+        '''
+        geometry = self.windowGeometries.pop(0) if self.windowGeometries else None
+        if self.multiProcess:
+            if self.hostPool is None:
+                from WindowHostPool import WindowHostPool # Imported on first use, startup doesn't need it
+                self.hostPool = WindowHostPool(self)
+                self.hostPool.setGifFrameInterval(self.refreshGovernor.gifFrameInterval())
+            newWindow = self.hostPool.createWindow({'moveWithWindow': self.moveWWindowCb.isChecked(),
+                                                    'keepCentered': self.keepCenteredCb.isChecked(),
+                                                    'sharedCanvas': self.sharedCanvasCb.isChecked(),
+                                                    'geometry': [geometry.x(), geometry.y(), geometry.width(), geometry.height()] if geometry else None})
+        else:
+            newWindow = self.windowPool.acquire()
+            if geometry:
+                newWindow.setGeometry(geometry)
         
         newWindow.imageMoved.connect(self.onImageMoved)
         newWindow.windowClosing.connect(self.removeImageWindow)
+        newWindow.needsSync.connect(self.syncScheduler.wake)
+        newWindow.geometryChanged.connect(self.syncScheduler.geometry.updateWindow)
+        if self.refreshGovernor.fastTransform:
+            newWindow.setFastTransform(True)
         
         newWindow.show()
         
         self.imageWindows.append(newWindow)
         
-        newWindow.loadImage(self.currentImagePath, self.scaleSlider.value() / 100)
-        
-        self.statusBar.showMessage('Opened new window', 3000)
-        
-        for window in self.imageWindows: # Sync GIF
-            window.restartGif()
+        newWindow.loadImage(self.currentImagePath, self.scaleSlider.value() / 100) # Shares the decoded image with the other windows
+        return newWindow
+
+    def openWindows(self, numWindows, geometries=None):
+        '''
+        Opens numWindows image windows in one batch, at the given geometries if there are any.
+        The windows are created a few at a time on consecutive turns of the event loop to keep the UI responsive,
+        the preview and the settings are applied once when the whole batch is done.
+        '''
+        self.windowGeometries.extend(geometries or [])
+        self.windowsToOpen += numWindows
+        if self.windowsToOpen == numWindows: # No batch running yet
+            self.openWindowBatch(0)
+
+    def openWindowBatch(self, numOpened):
+        '''
+        Creates the next few windows of the running batch and schedules the rest.
+        '''
+        for i in range(min(self.BATCH_SIZE, self.windowsToOpen)):
+            self.createImageWindow()
+            self.windowsToOpen -= 1
+            numOpened += 1
+            
+        if self.windowsToOpen:
+            QTimer.singleShot(0, lambda: self.openWindowBatch(numOpened))
+            return
             
         self.displayImagePreview()
-        
         self.updateAllSettings()
+        self.statusBar.showMessage('Opened {} windows!'.format(numOpened), 5000)
+        self.windowsOpened.emit(numOpened)
 
+    @profiled
     def onImageMoved(self, globalPos):
         '''
         Handles communication b/w windows on moving a window and updates the position of the images in other windows.
+        The moves are coalesced by the sync scheduler, so during a drag only the latest position is applied once per frame.
         '''
-        senderWindow = self.sender()
-        
-        for window in self.imageWindows:
-            if window is not senderWindow:
-                localPos = window.mapFromGlobal(globalPos)
-                window.imageLabel.move(localPos)
-                window.update()  # Refresh
-                window.isImageMoved = False    
+        self.syncScheduler.propagateMove(self.sender(), globalPos)
     
     def displayImagePreview(self):
         '''
         Display current image in  image display area and scale the image to fit the display area while maintaining aspect ratio.
-        '''
-        pixmap = QPixmap(self.currentImagePath)
+        The image is shared with the image windows through the image cache, so it's not decoded again.
+        Decoding and smooth scaling happen in the background, a placeholder or a quick approximation is shown until they're done.
+        The image is decoded straight at a resolution that's just large enough for the preview, if the windows don't already have a larger one.
+        '''
+        cache = ImageCache.instance()
+        size = self.imgDisp.size()
+        image = cache.cachedImage(self.currentImagePath, size, allowSmaller=True)
+        if not image or image.decodeScale < cache.decodeScale(self.currentImagePath, size):
+            ImageLoader.instance().requestImage(self.currentImagePath, size)
     
-        if not pixmap.isNull():
-            scaledPixmap = pixmap.scaled(self.imgDisp.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        if image:
+            scaledPixmap = cache.scaledPixmap(image, 0, size, Qt.KeepAspectRatio)
+            if scaledPixmap is None:
+                ImageLoader.instance().requestScale(image, size, Qt.KeepAspectRatio, [0], group='preview', owner=self)
+                scaledPixmap = cache.pixmap(image, 0, size, Qt.KeepAspectRatio, smooth=False)
         
             self.imgDisp.setPixmap(scaledPixmap)
             self.imgDisp.adjustSize() 
         else:
+            self.imgDisp.setText('Loading...')
+            
+    def onImageLoaded(self, imagePath, loaded):
+        '''
+        Show the preview once the current image has been decoded in the background.
+        '''
+        if imagePath != self.currentImagePath:
+            return
+        if loaded:
+            self.displayImagePreview()
+        else:
+            self.imgDisp.setText('Display the image here')
             self.statusBar.showMessage('Failed to load image.', 5000)
             
+    def onImageChanged(self, imagePath, scale):
+        '''
+        Decode the new version of a file that changed on disk once for all the windows and the preview, if any of them shows it.
+        The window hosts don't decode it themselves, they get it from this process like any other image.
+        It doesn't supersede the image that's being decoded for the windows, e.g. after switching to another image.
+        '''
+        if imagePath == self.currentImagePath or any(window.currentImagePath == imagePath for window in self.imageWindows):
+            ImageLoader.instance().requestImage(imagePath, scale=scale, supersede=False)
+
+    def onImageScaled(self, imageKey, size, aspectMode):
+        '''
+        Replace the approximate preview with the smoothly scaled one.
+        '''
+        if imageKey[0] == self.currentImagePath and aspectMode == Qt.KeepAspectRatio and size == self.imgDisp.size():
+            self.displayImagePreview()
+            
     def updateAllSettings(self):
         '''
         Single method to update all settings from the Main Window.
@@ -280,28 +454,55 @@ class MainWindow(QMainWindow):
         
     def updateTimeStep(self):
         '''
-        Update refresh rate of Update Function in the windows based on the radio button selected.
+        Update refresh rate of the sync scheduler based on the radio button selected.
+        'Fast' follows the refresh rate of the display, there's no point in updating more often than frames are shown.
+        With 'Auto' the refresh governor picks the time step and lowers the quality under load.
         '''
+        for window in self.imageWindows:
+            window.isImageMoved = False # Let the scheduler realign every image to the reference window
+
+        if self.autoR.isChecked():
+            if RefreshGovernor.current is not self.refreshGovernor:
+                self.refreshGovernor.start()
+            self.syncScheduler.wake()
+            return
+        self.refreshGovernor.stop()
+
         timeStep = 0
-        if self.fastR.isChecked():
-            timeStep = 1
+        if self.eventR.isChecked():
+            timeStep = None # Event driven
+        elif self.fastR.isChecked():
+            timeStep = SyncScheduler.frameTimeStep()
         elif self.medR.isChecked():
             timeStep = 100
         else:  
             timeStep = 2000
+            
+        self.syncScheduler.setTimeStep(timeStep)
         
-        for window in self.imageWindows:
-            window.updateFunction(timeStep)
-        
-    def updateImageScale(self):
+    def onScaleSliderMoved(self):
+        '''
+        Quickly apply an approximate scale while the slider moves and schedule the smooth one.
+        Smooth scaling that's still running for an older value is cancelled.
+        '''
+        ImageLoader.instance().cancelScaling('windows')
+        if RefreshGovernor.current:
+            RefreshGovernor.current.onInteraction()
+        self.updateImageScale(smooth=False)
+        if not self.scaleSlider.isSliderDown():
+            self.scaleIdleTimer.start()
+
+    def updateImageScale(self, smooth=True):
         '''
         Apply scale value from the slider to the all the image and their labels in the image window.
         '''
+        self.scaleIdleTimer.stop()
         scaleFactor = self.scaleSlider.value() / 100 # Scale = 1 
         
         for window in self.imageWindows:
-            window.setScale(scaleFactor) 
+            window.setScale(scaleFactor, smooth) 
             
+        self.syncScheduler.wake()
         self.statusBar.showMessage('Scale Value Assigned', 5000)
             
     def updateImageSettings(self):
@@ -311,10 +512,12 @@ class MainWindow(QMainWindow):
         '''
         moveWithWindow = self.moveWWindowCb.isChecked()
         keepCentered = self.keepCenteredCb.isChecked()
+        sharedCanvas = self.sharedCanvasCb.isChecked()
         
         for window in self.imageWindows:
             window.setMoveWithWindow(moveWithWindow)
             window.setKeepCentered(keepCentered)
+            window.setSharedCanvas(sharedCanvas)
             
         if (moveWithWindow ==  False):
             self.statusBar.showMessage('Parent window still moves the image for ref to other windows', 5000) # To be fixed
@@ -328,12 +531,9 @@ class MainWindow(QMainWindow):
         self.moveWWindowCb.setChecked(random.choice([True, False]))
         self.keepCenteredCb.setChecked(random.choice([True, False]))
         
-        random.choice([self.slowR, self.medR, self.fastR]).setChecked(True)
+        random.choice([self.slowR, self.medR, self.fastR, self.eventR, self.autoR]).setChecked(True)
         
-        for i in range(random.randint(2, 10)):  
-            self.openNewWindow()
-        
-        self.updateAllSettings()
+        self.openWindows(random.randint(2, 10)) # Applies all the settings once the windows are open
 
     def openMultipleWindows(self):
         '''
@@ -341,10 +541,7 @@ class MainWindow(QMainWindow):
         '''
         numWindows = int(self.numWindowsInput.text())
         
-        for i in range(numWindows):
-            self.openNewWindow()
-            
-        self.statusBar.showMessage('Opened {} windows!'.format(numWindows), 5000)
+        self.openWindows(numWindows)
               
     def closeAllImageWindows(self):
         '''
@@ -363,6 +560,64 @@ class MainWindow(QMainWindow):
         '''
         if window in self.imageWindows:
             self.imageWindows.remove(window)
+            self.syncScheduler.geometry.sync(self.imageWindows) # Forget the window, it may come back from the pool
+            self.syncScheduler.wake() # The reference window might have changed
+        if isinstance(window, ImageWindow):
+            self.windowPool.release(window)
+        
+    def saveSession(self):
+        '''
+        Save the windows and settings along with the frames they show, so the layout can be restored without decoding again.
+        '''
+        fileName, i = QFileDialog.getSaveFileName(self, 'Save Session', 'session.json', 'JSON Files (*.json)')
+        if fileName:
+            from Session import Session # Imported on first use, startup doesn't need it
+            Session.save(self, fileName)
+            self.statusBar.showMessage('Session saved', 5000)
+            
+    def restoreSession(self, fileName=None):
+        '''
+        Replace the windows and settings with the ones of a saved session.
+        '''
+        if not fileName:
+            fileName, i = QFileDialog.getOpenFileName(self, 'Restore Session', '', 'JSON Files (*.json)')
+        if not fileName:
+            return
+        from Session import Session # Imported on first use, startup doesn't need it
+        if not Session.restore(self, fileName):
+            self.statusBar.showMessage('Failed to restore session.', 5000)
+            
+    def onQualityLevelChanged(self, level):
+        '''
+        Pass the GIF frame rate chosen by the refresh governor on to the window hosts and tell the user.
+        '''
+        if self.hostPool:
+            self.hostPool.setGifFrameInterval(self.refreshGovernor.gifFrameInterval())
+        self.statusBar.showMessage('Quality lowered to level {} due to load'.format(level) if level else 'Full quality restored', 3000)
+
+    def setInstrumentationEnabled(self, enabled):
+        '''
+        Start or stop recording the performance of the hot paths, the summary is shown in the status bar while recording.
+        '''
+        Instrumentation.instance().setEnabled(enabled)
+        self.perfLabel.setText('Recording performance...')
+        self.perfLabel.setVisible(enabled)
+        
+    def exportPerformanceData(self):
+        '''
+        Save the recorded performance data as JSON.
+        '''
+        fileName, i = QFileDialog.getSaveFileName(self, 'Export Performance Data', 'performance.json', 'JSON Files (*.json)')
+        if fileName:
+            Instrumentation.instance().export(fileName)
+            self.statusBar.showMessage('Performance data exported', 5000)
+            
+    def setMultiProcess(self, enabled):
+        '''
+        Host the windows opened from now on in worker processes, spreading decoding, scaling and painting over several cores.
+        '''
+        self.multiProcess = enabled
+        self.statusBar.showMessage('New windows open in worker processes' if enabled else 'New windows open in this process', 5000)
         
     def confirmQuit(self):
         '''
@@ -378,4 +633,6 @@ class MainWindow(QMainWindow):
         returnVal = reply.exec_()
         
         if returnVal == QMessageBox.Yes:
+            if self.hostPool:
+                self.hostPool.shutdown()
             QApplication.instance().quit()
\ No newline at end of file
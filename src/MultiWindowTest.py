@@ -1,14 +1,44 @@
+import time
+startTime = time.perf_counter() # Taken before anything else is imported, so the startup profile includes the imports
 import sys
+import json
+import argparse
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 from MainWindow import MainWindow          
 
 def main():
     '''
     Creates the Image Window Manager that can be used to open the image windows.
+    A session saved from the File menu can be restored right away by passing it with --session.
+    With --profile-startup the app quits once it's interactive and prints the time to first paint and to interactive as JSON.
     '''
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description='Synchronize images across multiple windows.')
+    parser.add_argument('--session', help='Session file to restore on startup')
+    parser.add_argument('--profile-startup', action='store_true', help='Print the startup times in seconds and quit')
+    args, qtArgs = parser.parse_known_args()
+
+    importTime = time.perf_counter() - startTime
+    app = QApplication(sys.argv[:1] + qtArgs)
     main_window = MainWindow()
+    if args.profile_startup:
+        profileStartup(app, main_window, importTime)
     main_window.show()
+    if args.session:
+        main_window.restoreSession(args.session)
     sys.exit(app.exec_()) # For clean exit
 
-main()
\ No newline at end of file
+def profileStartup(app, main_window, importTime):
+    '''
+    Record when the main window is painted for the first time and when the event loop is free again after the deferred startup work.
+    '''
+    profile = {'imports': round(importTime, 4)}
+    main_window.firstPainted.connect(lambda: profile.update(firstPaint=round(time.perf_counter() - startTime, 4)))
+
+    def report():
+        profile['interactive'] = round(time.perf_counter() - startTime, 4)
+        print(json.dumps(profile))
+        app.quit()
+    main_window.startupFinished.connect(lambda: QTimer.singleShot(0, report))
+
+main()
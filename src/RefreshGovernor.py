@@ -0,0 +1,142 @@
+import math
+import time
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from AnimationClock import AnimationClock
+
+class RefreshGovernor(QObject):
+    '''
+    Drives the 'Auto' refresh rate. It measures what a frame of position updates and repaints costs and picks the time step
+    of the sync scheduler that keeps them within the CPU budget, at most one update per frame of the display.
+    When the process as a whole uses more than the budget, the quality is lowered one level at a time,
+    and raised one level at a time again once the load has stayed low for a while:
+    1. images are drawn with fast instead of smooth transformation while they're moved or scaled
+    2. GIFs play at 20 fps at most
+    3. GIFs play at 10 fps at most
+    '''
+    INTERVAL = 250 # In ms, how often the load is evaluated
+    CPU_BUDGET = 0.5 # Share of a core the app may use
+    MAX_TIME_STEP = 100 # Slowest position updates, the same as 'Medium'
+    RECOVER_INTERVALS = 8 # Intervals below half the budget before the quality is raised again
+    GIF_FRAME_INTERVALS = (0, 0, 50, 100) # Minimum time in ms between GIF frames for every quality level
+    levelChanged = pyqtSignal(int) # Signals the new quality level, 0 is full quality
+
+    current = None # The governor that's running, the hot paths only check this while none is
+
+    @classmethod
+    def recordPass(cls, seconds, moved):
+        '''
+        Record a pass of the sync scheduler, moved tells whether it moved any image, i.e. produced a frame.
+        '''
+        governor = cls.current
+        if governor:
+            governor.cost += seconds
+            if moved:
+                governor.frames += 1
+                governor.onInteraction()
+
+    @classmethod
+    def recordRepaint(cls, seconds):
+        '''
+        Record the time a window took to repaint.
+        '''
+        governor = cls.current
+        if governor:
+            governor.cost += seconds
+
+    def __init__(self, scheduler, windows, parent=None):
+        '''
+        The governor shares the list of image windows with the main window, like the sync scheduler.
+        '''
+        super().__init__(parent)
+        self.scheduler = scheduler
+        self.windows = windows
+        self.level = 0
+        self.fastTransform = False
+        self.timeStep = None
+        self.frameCost = None # Smoothed cost of a frame in seconds, None until one has been measured
+        self.calmIntervals = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.evaluate)
+        self.resetInterval()
+
+    def resetInterval(self):
+        self.cost = 0.0 # Seconds spent on position updates and repaints
+        self.frames = 0
+        self.interacting = False # Whether images were moved or scaled
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+
+    def gifFrameInterval(self):
+        return self.GIF_FRAME_INTERVALS[self.level]
+
+    def start(self):
+        '''
+        Take over the time step of the sync scheduler, starting at the display's frame rate.
+        '''
+        RefreshGovernor.current = self
+        self.frameCost = None
+        self.calmIntervals = 0
+        self.timeStep = self.scheduler.frameTimeStep()
+        self.scheduler.adjustTimeStep(self.timeStep)
+        self.resetInterval()
+        self.timer.start(self.INTERVAL)
+
+    def stop(self):
+        '''
+        Stop governing and restore full quality.
+        '''
+        if RefreshGovernor.current is self:
+            RefreshGovernor.current = None
+        self.timer.stop()
+        self.setLevel(0)
+
+    def onInteraction(self):
+        '''
+        Images are being moved or scaled, switch to fast transformation right away if the load asks for it.
+        '''
+        self.interacting = True
+        if self.level and not self.fastTransform:
+            self.setFastTransform(True)
+
+    def evaluate(self):
+        '''
+        Adjust the time step to the cost of the frames in the last interval and the quality level to the CPU load.
+        '''
+        wallTime = time.perf_counter() - self.wallStart
+        cpu = (time.process_time() - self.cpuStart) / wallTime if wallTime else 0
+        if self.frames:
+            frameCost = self.cost / self.frames
+            self.frameCost = frameCost if self.frameCost is None else (self.frameCost + frameCost) / 2
+            timeStep = min(self.MAX_TIME_STEP, max(self.scheduler.frameTimeStep(), math.ceil(self.frameCost * 1000 / self.CPU_BUDGET)))
+            if timeStep != self.timeStep:
+                self.timeStep = timeStep
+                self.scheduler.adjustTimeStep(timeStep)
+
+        if cpu > self.CPU_BUDGET:
+            self.calmIntervals = 0
+            self.setLevel(min(self.level + 1, len(self.GIF_FRAME_INTERVALS) - 1))
+        elif cpu < self.CPU_BUDGET / 2:
+            self.calmIntervals += 1
+            if self.level and self.calmIntervals >= self.RECOVER_INTERVALS:
+                self.calmIntervals = 0
+                self.setLevel(self.level - 1)
+        else:
+            self.calmIntervals = 0
+
+        if self.fastTransform and not self.interacting:
+            self.setFastTransform(False) # Everything has settled, draw smoothly again
+        self.resetInterval()
+
+    def setLevel(self, level):
+        if level == self.level:
+            return
+        self.level = level
+        AnimationClock.instance().setMinFrameInterval(self.gifFrameInterval())
+        if not level and self.fastTransform:
+            self.setFastTransform(False)
+        self.levelChanged.emit(level)
+
+    def setFastTransform(self, state):
+        self.fastTransform = state
+        for window in self.windows:
+            window.setFastTransform(state)
@@ -0,0 +1,119 @@
+import json
+from PyQt5.QtCore import QPoint, QRect, QSize, Qt
+from ImageCache import ImageCache, CachedImage
+from FrameDiskCache import FrameDiskCache
+
+class Session:
+    '''
+    Save and restore of the whole session: the image, the settings of the main window and the geometry of every window.
+    The decoded and scaled frames the windows show are written to the frame disk cache along with it,
+    so a restored layout shows its images straight from the memory-mapped files without decoding anything.
+    '''
+    VERSION = 1
+    REFRESH_RATES = ('slow', 'medium', 'fast', 'onChange', 'auto')
+
+    @staticmethod
+    def refreshButtons(mainWindow):
+        return dict(zip(Session.REFRESH_RATES, (mainWindow.slowR, mainWindow.medR, mainWindow.fastR, mainWindow.eventR, mainWindow.autoR)))
+
+    @classmethod
+    def capture(cls, mainWindow):
+        '''
+        The state of the session as a JSON serializable dict.
+        Window geometries are the global rects of the client areas, which works the same for windows hosted by worker processes.
+        '''
+        windows = []
+        for window in mainWindow.imageWindows:
+            origin = window.mapToGlobal(QPoint(0, 0))
+            windows.append([origin.x(), origin.y(), window.size().width(), window.size().height()])
+        refreshRate = next(name for name, button in cls.refreshButtons(mainWindow).items() if button.isChecked())
+        return {'version': cls.VERSION,
+                'imagePath': mainWindow.currentImagePath,
+                'scale': mainWindow.scaleSlider.value(),
+                'moveWithWindow': mainWindow.moveWWindowCb.isChecked(),
+                'keepCentered': mainWindow.keepCenteredCb.isChecked(),
+                'sharedCanvas': mainWindow.sharedCanvasCb.isChecked(),
+                'refreshRate': refreshRate,
+                'windows': windows,
+                'frames': cls.saveFrames(mainWindow)}
+
+    @staticmethod
+    def saveFrames(mainWindow):
+        '''
+        Write the decoded image and the scaled first frames the windows of this process show to the frame disk cache.
+        Returns the entries needed to load them again.
+        '''
+        cache = ImageCache.instance()
+        diskCache = FrameDiskCache.instance()
+        entries = {} # image key -> entry
+        for window in mainWindow.imageWindows:
+            image = getattr(window, 'image', None) # Windows hosted by worker processes have their own caches
+            if image is None:
+                continue
+            entry = entries.get(image.key)
+            if entry is None:
+                diskCache.save(('image',) + image.key, image.frames[0])
+                entry = entries[image.key] = {'key': list(image.key), 'frameCount': image.frameCount(), 'delays': image.delays[:1], 'scaled': []}
+
+            size = window.scaledSize
+            scaledSize = [size.width(), size.height(), int(window.aspectMode)] if size else None
+            pixmap = cache.scaledPixmap(image, 0, size, window.aspectMode) if size else None
+            if pixmap and scaledSize not in entry['scaled']:
+                diskCache.save(('pixmap', image.key, 0) + tuple(scaledSize), pixmap.toImage())
+                entry['scaled'].append(scaledSize)
+        diskCache.trim()
+        return list(entries.values())
+
+    @staticmethod
+    def loadFrames(entries):
+        '''
+        Put the frames saved with a session into the image cache, skipping the ones whose file has changed since.
+        '''
+        cache = ImageCache.instance()
+        diskCache = FrameDiskCache.instance()
+        for entry in entries:
+            key = tuple(entry['key'])
+            frame = diskCache.load(('image',) + key) if ImageCache.imageKey(key[0]) == key[:2] else None
+            if frame is None:
+                continue
+            image = CachedImage(key, [frame], list(entry['delays']), entry['frameCount'])
+            cache.addImage(image)
+            for width, height, aspectMode in entry['scaled']:
+                scaledFrame = diskCache.load(('pixmap', key, 0, width, height, aspectMode))
+                if scaledFrame is not None:
+                    cache.addScaledFrame(image, 0, QSize(width, height), Qt.AspectRatioMode(aspectMode), scaledFrame)
+
+    @classmethod
+    def save(cls, mainWindow, fileName):
+        with open(fileName, 'w') as file:
+            json.dump(cls.capture(mainWindow), file, indent=2)
+
+    @classmethod
+    def restore(cls, mainWindow, fileName):
+        '''
+        Replace the open windows and the settings with the ones of a saved session.
+        Returns False if the file isn't a session that can be restored.
+        '''
+        try:
+            with open(fileName) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if state.get('version') != cls.VERSION:
+            return False
+
+        mainWindow.closeAllImageWindows()
+        cls.loadFrames(state['frames'])
+        mainWindow.currentImagePath = state['imagePath']
+        mainWindow.scaleSlider.setValue(state['scale'])
+        mainWindow.moveWWindowCb.setChecked(state['moveWithWindow'])
+        mainWindow.keepCenteredCb.setChecked(state['keepCentered'])
+        mainWindow.sharedCanvasCb.setChecked(state['sharedCanvas'])
+        cls.refreshButtons(mainWindow)[state['refreshRate']].setChecked(True)
+
+        if state['windows']:
+            mainWindow.openWindows(len(state['windows']), [QRect(*geometry) for geometry in state['windows']]) # Applies the settings once they're open
+        else:
+            mainWindow.displayImagePreview()
+            mainWindow.updateAllSettings()
+        return True
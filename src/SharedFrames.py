@@ -0,0 +1,93 @@
+import os
+import itertools
+from collections import OrderedDict
+from PyQt5.QtCore import QSharedMemory
+from PyQt5.QtGui import QImage
+from ImageCache import CachedImage
+
+class SharedFrames:
+    '''
+    Publishes decoded images into shared memory so the window host processes don't have to decode them again.
+    The main process copies the pixels into a segment once, every host copies them out of it into its own image cache.
+    Only the cached frames are published, i.e. the first frame of a GIF, the hosts stream the other frames themselves.
+    '''
+    MAX_PUBLISHED = 4 # Files whose latest version stays published, older ones are released
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The publisher shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.published = OrderedDict() # path -> (description, segments), ordered from least to most recently published
+        self.counter = itertools.count()
+
+    def publish(self, cachedImage):
+        '''
+        Copy the frames of an image into shared memory and return the description the hosts attach to.
+        The previously published version of the same file is released. Returns None if shared memory isn't available.
+        '''
+        path = cachedImage.key[0]
+        entry = self.published.get(path)
+        if entry and tuple(entry[0]['key']) == cachedImage.key:
+            self.published.move_to_end(path)
+            return entry[0]
+
+        frames = []
+        segments = []
+        for frame in cachedImage.frames:
+            segment = QSharedMemory('MultiWindowSync-{}-{}'.format(os.getpid(), next(self.counter)))
+            if not segment.create(max(1, frame.sizeInBytes())):
+                return None
+            data = segment.data()
+            data.setsize(frame.sizeInBytes())
+            segment.lock()
+            memoryview(data)[:] = frame.constBits().asstring(frame.sizeInBytes())
+            segment.unlock()
+            segments.append(segment)
+            frames.append({'segment': segment.key(), 'width': frame.width(), 'height': frame.height(),
+                           'bytesPerLine': frame.bytesPerLine(), 'format': int(frame.format())})
+
+        description = {'key': list(cachedImage.key), 'frames': frames, 'delays': cachedImage.delays[:len(frames)],
+                       'frameCount': cachedImage.frameCount()}
+        self.release(path)
+        self.published[path] = (description, segments)
+        while len(self.published) > self.MAX_PUBLISHED:
+            self.published.popitem(last=False) # Dropping the segments detaches them
+        return description
+
+    def descriptions(self):
+        '''
+        Descriptions of everything that's published, e.g. for a host that just connected.
+        '''
+        return [description for description, segments in self.published.values()]
+
+    def release(self, path):
+        self.published.pop(path, None)
+
+    def clear(self):
+        self.published.clear()
+
+    @staticmethod
+    def attach(description):
+        '''
+        Copy a published image out of shared memory, None if it has been released in the meantime.
+        Runs in the host processes.
+        '''
+        frames = []
+        for frame in description['frames']:
+            segment = QSharedMemory(frame['segment'])
+            if not segment.attach(QSharedMemory.ReadOnly):
+                return None
+            segment.lock()
+            data = segment.constData().asstring(frame['bytesPerLine'] * frame['height'])
+            segment.unlock()
+            segment.detach()
+            frames.append(QImage(data, frame['width'], frame['height'], frame['bytesPerLine'], QImage.Format(frame['format'])).copy())
+        return CachedImage(tuple(description['key']), frames, list(description['delays']), description['frameCount'])
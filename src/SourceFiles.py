@@ -0,0 +1,144 @@
+import os
+from PyQt5.QtCore import QBuffer, QByteArray, QFileSystemWatcher, QIODevice, QObject, QTimer, pyqtSignal
+from PyQt5.QtGui import QImageReader
+
+class SourceFile:
+    '''
+    The bytes of one version of an image file, read once and shared by every reader of that version.
+    The bytes are copied into memory rather than mapped: an editor saving the file in place truncates it,
+    and a reader still going through a mapping of it, e.g. a playing GIF or a worker, would crash the process.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.mtime = os.fstat(file.fileno()).st_mtime
+            self.data = QByteArray(file.read())
+        self.format = os.path.splitext(path)[1][1:].lower().encode() # Hint for the reader, like a reader of the file would use
+
+    def key(self):
+        return (self.path, self.mtime)
+
+    def reader(self):
+        '''
+        A reader over the bytes of the file through an in-memory buffer, it can be used on any thread.
+        The reader keeps the buffer and the bytes alive for as long as it's in use, even once the file has changed.
+        '''
+        buffer = QBuffer()
+        buffer.setData(self.data) # Shares the bytes
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer, self.format)
+        reader.buffer = buffer
+        reader.source = self
+        return reader
+
+class SourceFiles(QObject):
+    '''
+    Every image file the app shows is read once and kept while the image cache holds anything of it, so decoding it again,
+    reading its header or checking whether it's still the same version doesn't touch the disk. The files are watched
+    instead of checked: once a file is edited it's read again and fileChanged is emitted, so the new version is decoded
+    once for all the windows.
+    Files that don't exist are remembered as missing and picked up once they're created.
+    The files are only opened on the GUI thread, the workers get readers of the files.
+    '''
+    RELOAD_DELAY = 100 # In ms, changes are coalesced for a while since saving a file can take several writes
+    fileChanged = pyqtSignal(str) # Path of a file that has a new version on disk, or is gone
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The file layer shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.files = {} # path -> SourceFile, None if the file doesn't exist or can't be read
+        self.changedPaths = set() # Files that changed since the last reload
+        self.reloadTimer = QTimer(self)
+        self.reloadTimer.setSingleShot(True)
+        self.reloadTimer.setInterval(self.RELOAD_DELAY)
+        self.reloadTimer.timeout.connect(self.reloadChanged)
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.onChanged)
+        self.watcher.directoryChanged.connect(self.onDirectoryChanged)
+
+    def file(self, path):
+        '''
+        The current version of the file at path, None if it can't be read.
+        '''
+        if path in self.files:
+            return self.files[path]
+        try:
+            source = SourceFile(path)
+        except OSError:
+            source = None
+        self.files[path] = source
+        if source is None: # Watch the directory for the file to be created
+            directory = os.path.dirname(path) or '.'
+            if os.path.isdir(directory) and directory not in self.watcher.directories():
+                self.watcher.addPath(directory)
+        else:
+            self.watcher.removePath(path) # A replaced file is still watched under its path until the watcher notices
+            self.watcher.addPath(path)
+        return source
+
+    def key(self, path):
+        '''
+        (path, mtime) identifying the current version of the file at path, None if it can't be read.
+        '''
+        source = self.file(path)
+        return source.key() if source else None
+
+    def reader(self, path):
+        '''
+        A reader of the current version of the file at path, a reader that fails if it can't be read.
+        '''
+        source = self.file(path)
+        return source.reader() if source else QImageReader()
+
+    def release(self, path):
+        '''
+        Forget the file at path and stop watching it once nothing is cached for it anymore, it's read again on its next use.
+        Readers that are still in use keep the version they were created from.
+        '''
+        if path not in self.files:
+            return
+        source = self.files.pop(path)
+        self.changedPaths.discard(path)
+        if source is not None:
+            self.watcher.removePath(path)
+            return
+        directory = os.path.dirname(path) or '.'
+        if not any(other is None and (os.path.dirname(otherPath) or '.') == directory for otherPath, other in self.files.items()):
+            self.watcher.removePath(directory) # No other missing file to wait for in it
+
+    def onChanged(self, path):
+        self.changedPaths.add(path)
+        self.reloadTimer.start()
+
+    def reloadChanged(self):
+        paths, self.changedPaths = self.changedPaths, set()
+        for path in paths:
+            self.refresh(path)
+
+    def refresh(self, path):
+        '''
+        Read the file at path again after it was changed, emitting fileChanged if there's a new version.
+        Saving a file by replacing it stops it from being watched, so it's watched again.
+        '''
+        old = self.files.pop(path, None)
+        new = self.file(path)
+        if (old.key() if old else None) != (new.key() if new else None):
+            self.fileChanged.emit(path)
+
+    def onDirectoryChanged(self, directory):
+        '''
+        Pick up the missing files of a directory once they're created.
+        '''
+        for path, source in list(self.files.items()):
+            if source is None and (os.path.dirname(path) or '.') == directory:
+                self.onChanged(path)
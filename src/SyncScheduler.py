@@ -0,0 +1,171 @@
+import time
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QElapsedTimer, QObject, QTimer, Qt
+from Instrumentation import Instrumentation, profiled
+from WindowGeometry import WindowGeometry
+from RefreshGovernor import RefreshGovernor
+
+class SyncScheduler(QObject):
+    '''
+    A single timer owned by the main window that keeps the image positions of all the image windows in sync.
+    Every tick updates all the windows in one pass and the timer goes idle once nothing has moved for a while.
+    In the event driven mode there are no ticks at all, a pass only runs after something has changed.
+    '''
+    IDLE_TIMEOUT = 500 # Time in ms without any movement before the scheduler stops waking up
+
+    def __init__(self, windows, parent=None):
+        '''
+        The scheduler shares the list of image windows with the main window, so opened and closed windows are picked up automatically.
+        '''
+        super().__init__(parent)
+        self.windows = windows
+        self.geometry = WindowGeometry() # Origins and image offsets of the windows, kept up to date by their move and resize events
+        self.idleTicks = 0
+        self.eventDriven = False
+        self.moveTimeStep = None # Minimum time between applied moves set by the refresh governor, a frame of the display otherwise
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.setTimeStep(self.frameTimeStep())
+        
+        self.pendingMove = None # (window, global image position) of the latest move that hasn't been applied yet
+        self.lastMove = QElapsedTimer()
+        self.moveTimer = QTimer(self)
+        self.moveTimer.setSingleShot(True)
+        self.moveTimer.setTimerType(Qt.PreciseTimer)
+        self.moveTimer.timeout.connect(self.applyPendingMove)
+
+    @staticmethod
+    def frameTimeStep():
+        '''
+        Duration of a single frame of the primary screen in ms, used as the time step for the 'Fast' refresh rate.
+        '''
+        screen = QApplication.primaryScreen()
+        refreshRate = screen.refreshRate() if screen else 0
+        return max(1, round(1000 / (refreshRate or 60)))
+
+    def setTimeStep(self, timeStep):
+        '''
+        Change how often the scheduler ticks. The same timer is reused so changing the settings never stacks timers.
+        A timeStep of None switches to the event driven mode.
+        '''
+        self.eventDriven = timeStep is None
+        self.moveTimeStep = None
+        self.timer.stop()
+        self.timer.setSingleShot(self.eventDriven)
+        self.timer.setInterval(0 if self.eventDriven else timeStep)
+        self.wake()
+
+    def adjustTimeStep(self, timeStep):
+        '''
+        Change the time step while ticking, e.g. by the refresh governor. Unlike setTimeStep it doesn't wake the scheduler,
+        and moves are coalesced over the same time step.
+        '''
+        self.eventDriven = False
+        self.moveTimeStep = timeStep
+        self.timer.setSingleShot(False)
+        self.timer.setInterval(timeStep) # Restarts the timer if it's active
+
+    def wake(self):
+        '''
+        Resume ticking after something changed, e.g. a window was moved, resized, opened or the settings changed.
+        In the event driven mode all the changes until the next turn of the event loop are coalesced into a single pass.
+        '''
+        self.idleTicks = 0
+        if self.windows and not self.timer.isActive():
+            self.timer.start()
+
+    def referenceWindow(self):
+        '''
+        The window that governs the image positions.
+        With 'Keep Centered' checked it's the active window, otherwise the first one that was opened.
+        Windows hosted by other processes report whether they're active themselves.
+        '''
+        for window in self.windows:
+            if window.keepCentered and window.isActiveWindow():
+                return window
+        return self.windows[0]
+
+    @profiled
+    def syncAll(self):
+        '''
+        Align the images of all the windows to the image of the reference window.
+        The reference position is computed once in global coordinates, the local positions of all the other windows
+        are computed from it in one step and only the images that aren't in place yet are moved.
+        Windows that were moved by hand, hidden ones and the ones without an image are left alone.
+        Returns True if any image had to be moved.
+        '''
+        if not self.windows:
+            return False
+
+        self.geometry.sync(self.windows)
+        refWindow = self.referenceWindow()
+        moved = False
+        if refWindow.keepCentered and refWindow.isActiveWindow() and not refWindow.isImageMoved:
+            moved = refWindow.centerImage()
+            if moved:
+                self.geometry.updateWindow(refWindow)
+        globalPos = refWindow.imageGlobalPos()
+
+        eligible = [window is not refWindow and window.isShown and not window.isImageMoved and bool(window.currentImagePath)
+                    for window in self.windows]
+        for window, localPos in self.geometry.changedOffsets(globalPos, eligible):
+            window.moveImage(localPos)
+            moved = True
+        return moved
+
+    def propagateMove(self, senderWindow, globalPos):
+        '''
+        Move the images of all the other windows to the image position of a window that was moved.
+        Moves are coalesced so that only the latest position is applied, at most once per frame.
+        '''
+        self.pendingMove = (senderWindow, globalPos)
+        if self.moveTimer.isActive():
+            return
+        
+        timeStep = self.moveTimeStep or self.frameTimeStep()
+        sinceLastMove = self.lastMove.elapsed() if self.lastMove.isValid() else timeStep
+        self.moveTimer.start(max(0, timeStep - sinceLastMove))
+
+    @profiled
+    def applyPendingMove(self):
+        '''
+        Apply the latest move. The local positions of all the windows are computed in one step from the stored geometry,
+        then only the labels that actually have to move are touched.
+        '''
+        if self.pendingMove is None:
+            return
+        senderWindow, globalPos = self.pendingMove
+        self.pendingMove = None
+        self.lastMove.start()
+        start = time.perf_counter()
+
+        self.geometry.sync(self.windows)
+        eligible = [window is not senderWindow and window.isShown for window in self.windows] # Hidden windows resync once they're shown
+        for window, localPos in self.geometry.changedOffsets(globalPos, eligible):
+            window.moveImage(localPos)
+        for window, isEligible in zip(self.windows, eligible):
+            if isEligible:
+                window.isImageMoved = False
+        RefreshGovernor.recordPass(time.perf_counter() - start, True)
+
+    def tick(self):
+        '''
+        Update the image position of every window in a single pass.
+        Stop the timer once no image has moved for IDLE_TIMEOUT ms, the next change wakes it up again.
+        '''
+        Instrumentation.countWakeup('syncScheduler')
+        start = time.perf_counter()
+        moved = self.syncAll()
+        RefreshGovernor.recordPass(time.perf_counter() - start, moved)
+        if self.eventDriven:
+            return
+
+        if moved:
+            self.idleTicks = 0
+            return
+
+        self.idleTicks += 1
+        if self.idleTicks * self.timer.interval() >= self.IDLE_TIMEOUT:
+            self.timer.stop()
@@ -0,0 +1,124 @@
+import math
+from collections import OrderedDict
+from PyQt5.QtCore import QObject, QPoint, QRect, QSize, pyqtSignal
+from PyQt5.QtGui import QPixmap
+from ImageLoader import ImageLoader
+from SourceFiles import SourceFiles
+
+class TileCache(QObject):
+    '''
+    Fixed size tiles of images that are too large to be decoded as a whole, decoded lazily on the worker pool.
+    Tiles are laid out on levels that halve the resolution of the image, so a window only needs the tiles of the level
+    closest to its scale that overlap its visible rect. Each tile is decoded with a clip rect, and the least recently
+    used tiles are dropped once the memory cap is exceeded.
+    Only images whose format decodes a clip rect natively are tiled, the image cache decides which ones are.
+    '''
+    TILE_SIZE = 256 # In pixels of the level
+    DEFAULT_BUDGET = 256 * 1024 * 1024 # In bytes
+    MAX_PENDING = 64 # Tiles waiting to be decoded, older requests are cancelled when windows move on
+    tileReady = pyqtSignal(object) # Key of the image a tile was decoded for
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        '''
+        The tile cache shared by the whole process.
+        '''
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, memoryBudget=DEFAULT_BUDGET, parent=None):
+        super().__init__(parent)
+        self.memoryBudget = memoryBudget
+        self.memoryUsed = 0
+        self.tiles = OrderedDict() # (image key, level, column, row) -> pixmap, ordered from least to most recently used
+        self.pending = OrderedDict() # (image key, level, column, row) -> job
+
+    def setMemoryBudget(self, memoryBudget):
+        self.memoryBudget = memoryBudget
+        self.evict()
+
+    @staticmethod
+    def levelFor(scale):
+        '''
+        Resolution of the tiles used to show an image at scale, the closest power of two above it but never more than the full size.
+        '''
+        if scale >= 1:
+            return 1
+        return 2 ** math.ceil(math.log2(scale))
+
+    def tilesFor(self, imageKey, fullSize, level, levelRect):
+        '''
+        The tiles of a level overlapping levelRect, given in pixels of the level.
+        Returns a list of (tile rect in pixels of the level, pixmap or None if it's still being decoded).
+        Missing tiles are requested from the worker pool.
+        '''
+        levelSize = QSize(max(1, round(fullSize.width() * level)), max(1, round(fullSize.height() * level)))
+        levelRect = levelRect.intersected(QRect(QPoint(0, 0), levelSize))
+        if levelRect.isEmpty():
+            return []
+
+        tiles = []
+        for row in range(levelRect.top() // self.TILE_SIZE, levelRect.bottom() // self.TILE_SIZE + 1):
+            for column in range(levelRect.left() // self.TILE_SIZE, levelRect.right() // self.TILE_SIZE + 1):
+                tileRect = QRect(column * self.TILE_SIZE, row * self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE).intersected(QRect(QPoint(0, 0), levelSize))
+                key = (imageKey, level, column, row)
+                pixmap = self.tiles.get(key)
+                if pixmap is None:
+                    self.requestTile(key, fullSize, tileRect)
+                else:
+                    self.tiles.move_to_end(key)
+                tiles.append((tileRect, pixmap))
+        return tiles
+
+    def requestTile(self, key, fullSize, tileRect):
+        '''
+        Decode a single tile in the background. Only the part of the file under the tile is decoded, straight at the level's resolution.
+        '''
+        if key in self.pending:
+            self.pending.move_to_end(key)
+            return
+        imageKey, level = key[:2]
+        source = SourceFiles.instance().file(imageKey[0])
+        if source is None or source.key() != imageKey:
+            return # The file has changed, the windows are about to show the new version
+
+        def decode(job):
+            reader = source.reader()
+            clipRect = QRect(math.floor(tileRect.x() / level), math.floor(tileRect.y() / level),
+                             math.ceil(tileRect.width() / level), math.ceil(tileRect.height() / level))
+            reader.setClipRect(clipRect.intersected(QRect(QPoint(0, 0), fullSize)))
+            reader.setScaledSize(tileRect.size())
+            return reader.read() if not job.cancelled else None
+
+        self.pending[key] = ImageLoader.instance().startJob(decode, lambda job, tile: self.onTileDecoded(key, job, tile))
+        while len(self.pending) > self.MAX_PENDING:
+            staleKey, staleJob = self.pending.popitem(last=False)
+            ImageLoader.instance().cancelJob(staleJob)
+
+    def onTileDecoded(self, key, job, tile):
+        if self.pending.get(key) is not job:
+            return # Cancelled
+        del self.pending[key]
+        if tile is None or tile.isNull():
+            return
+
+        pixmap = QPixmap.fromImage(tile)
+        self.tiles[key] = pixmap
+        self.memoryUsed += pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        self.evict()
+        self.tileReady.emit(key[0])
+
+    def evict(self):
+        while self.memoryUsed > self.memoryBudget and self.tiles:
+            key, pixmap = self.tiles.popitem(last=False)
+            self.memoryUsed -= pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def clear(self):
+        for job in self.pending.values():
+            ImageLoader.instance().cancelJob(job)
+        self.pending.clear()
+        self.tiles.clear()
+        self.memoryUsed = 0
@@ -0,0 +1,93 @@
+from PyQt5.QtCore import QPoint
+
+numpy = False # Imported once the first window is opened, it would take a large part of the startup time
+
+def importNumpy():
+    '''
+    Import NumPy on first use, None if it isn't installed.
+    '''
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError: # Falls back to plain lists, same results only slower with many windows
+            numpy = None
+    return numpy
+
+class WindowGeometry:
+    '''
+    Compact store of what the sync scheduler needs to align the images: the global origin of every window and
+    the offset of its image within the window. Rows are updated from the move and resize events of the windows and
+    whenever the scheduler moves an image, so a sync pass doesn't have to query the widgets.
+    The local image positions of all the windows are computed in one vectorized step with NumPy if it's installed.
+    '''
+    def __init__(self):
+        self.windows = [] # Windows in the order of the rows
+        self.rows = {} # window -> row
+        self.origins = [] # Rows of (x, y), a NumPy array once there are windows
+        self.offsets = []
+
+    @staticmethod
+    def newArray(numRows):
+        return numpy.zeros((numRows, 2), dtype=numpy.int64) if numpy else [[0, 0] for row in range(numRows)]
+
+    def sync(self, windows):
+        '''
+        Match the rows to the list of windows after windows were opened or closed, known windows keep their values.
+        '''
+        if windows == self.windows:
+            return
+        importNumpy()
+        origins = self.newArray(len(windows))
+        offsets = self.newArray(len(windows))
+        rows = {}
+        for row, window in enumerate(windows):
+            oldRow = self.rows.get(window)
+            if oldRow is None:
+                origin = window.mapToGlobal(QPoint(0, 0))
+                imagePos = window.imageGlobalPos()
+                origins[row] = [origin.x(), origin.y()]
+                offsets[row] = [imagePos.x() - origin.x(), imagePos.y() - origin.y()]
+            else:
+                origins[row] = list(self.origins[oldRow])
+                offsets[row] = list(self.offsets[oldRow])
+            rows[window] = row
+        self.windows = list(windows)
+        self.rows = rows
+        self.origins = origins
+        self.offsets = offsets
+
+    def updateWindow(self, window):
+        '''
+        Record the origin and image offset of a window after it was moved or resized, or its image was moved by something
+        other than the scheduler, e.g. centered.
+        '''
+        row = self.rows.get(window)
+        if row is not None:
+            origin = window.mapToGlobal(QPoint(0, 0))
+            imagePos = window.imageGlobalPos()
+            self.origins[row] = [origin.x(), origin.y()]
+            self.offsets[row] = [imagePos.x() - origin.x(), imagePos.y() - origin.y()]
+
+    def changedOffsets(self, globalPos, eligible):
+        '''
+        Local positions that put the images of the eligible windows at globalPos, only for the windows whose image isn't there yet.
+        eligible is one flag per row. The new offsets are recorded, the caller moves the images.
+        Returns a list of (window, local position).
+        '''
+        if not self.windows:
+            return []
+        if numpy:
+            targets = numpy.array([globalPos.x(), globalPos.y()]) - self.origins
+            changed = numpy.flatnonzero(numpy.any(targets != self.offsets, axis=1) & numpy.array(eligible, dtype=bool))
+            self.offsets[changed] = targets[changed]
+            return [(self.windows[row], QPoint(int(targets[row, 0]), int(targets[row, 1]))) for row in changed]
+
+        moves = []
+        for row, window in enumerate(self.windows):
+            target = [globalPos.x() - self.origins[row][0], globalPos.y() - self.origins[row][1]]
+            if eligible[row] and target != self.offsets[row]:
+                self.offsets[row] = target
+                moves.append((window, QPoint(*target)))
+        return moves
@@ -0,0 +1,160 @@
+import sys
+import json
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QObject, QPoint, QRect, pyqtSignal
+from PyQt5.QtNetwork import QLocalSocket
+from ImageWindow import ImageWindow
+from ImageCache import ImageCache
+from ImageLoader import ImageLoader
+from AnimationClock import AnimationClock
+from SharedFrames import SharedFrames
+from SourceFiles import SourceFiles
+
+class Channel(QObject):
+    '''
+    Newline delimited JSON messages over a local socket, used between the main process and the window hosts.
+    '''
+    messageReceived = pyqtSignal(dict)
+
+    def __init__(self, socket, parent=None):
+        super().__init__(parent)
+        self.socket = socket
+        self.buffer = b''
+        self.outbox = [] # Messages written before the socket is connected
+        socket.readyRead.connect(self.onReadyRead)
+        socket.connected.connect(self.flush)
+
+    def send(self, message):
+        self.outbox.append(json.dumps(message).encode() + b'\n')
+        if self.socket.state() == QLocalSocket.ConnectedState:
+            self.flush()
+
+    def flush(self):
+        if self.outbox:
+            self.socket.write(b''.join(self.outbox))
+            self.outbox = []
+
+    def onReadyRead(self):
+        self.buffer += bytes(self.socket.readAll())
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            self.messageReceived.emit(json.loads(line))
+
+class WindowHost(QObject):
+    '''
+    Runs in a worker process launched by the main window and hosts a group of image windows,
+    so decoding, scaling and painting of the windows is spread over several cores.
+    The main process sends the window settings and image positions over a local socket, the host reports back
+    window moves, closes and the state the sync scheduler needs. Decoded images arrive through shared memory.
+    '''
+    def __init__(self, serverName, hostIndex, parent=None):
+        super().__init__(parent)
+        self.windows = {} # window id -> ImageWindow
+        socket = QLocalSocket(self)
+        socket.disconnected.connect(QApplication.instance().quit) # The main process is gone
+        self.channel = Channel(socket, self)
+        self.channel.messageReceived.connect(self.onMessage)
+        self.handlers = {'open': self.openWindow, 'load': self.loadImage, 'image': self.addImage, 'scale': self.setScale,
+                         'settings': self.applySettings, 'move': self.moveImage, 'center': self.centerImage,
+                         'resetMoved': self.resetMoved, 'gifFrameInterval': self.setGifFrameInterval, 'close': self.closeWindow, 'quit': self.quit}
+        self.channel.send({'type': 'hello', 'host': hostIndex})
+        socket.connectToServer(serverName)
+
+    def onMessage(self, message):
+        handler = self.handlers.get(message['type'])
+        window = self.windows.get(message.get('id'))
+        if handler is None or ('id' in message and message['type'] != 'open' and window is None):
+            return # Unknown message or the window closed in the meantime
+        handler(window, message)
+
+    def sendState(self, windowId, window, sync=False):
+        '''
+        Report what the sync scheduler of the main process needs to know about a window.
+        '''
+        origin = window.mapToGlobal(QPoint(0, 0))
+        imagePos = window.imageGlobalPos()
+        self.channel.send({'type': 'state', 'id': windowId, 'origin': [origin.x(), origin.y()], 'imagePos': [imagePos.x(), imagePos.y()],
+                           'size': [window.width(), window.height()], 'shown': window.isShown, 'active': window.isActiveWindow(),
+                           'moved': window.isImageMoved, 'sync': sync})
+
+    def openWindow(self, window, message):
+        windowId = message['id']
+        window = ImageWindow()
+        self.windows[windowId] = window
+        window.imageMoved.connect(lambda pos: self.channel.send({'type': 'imageMoved', 'id': windowId, 'pos': [pos.x(), pos.y()]}))
+        window.windowClosing.connect(lambda window: self.onWindowClosing(windowId))
+        window.needsSync.connect(lambda: self.sendState(windowId, window, sync=True))
+        window.visibilityChanged.connect(lambda shown: self.sendState(windowId, window, sync=True))
+        self.applySettings(window, message)
+        if message.get('geometry'):
+            window.setGeometry(QRect(*message['geometry']))
+        window.show()
+        self.sendState(windowId, window)
+
+    def onWindowClosing(self, windowId):
+        window = self.windows.pop(windowId, None)
+        if window:
+            window.deleteLater() # Released by its close event, deleted once that's done
+        self.channel.send({'type': 'windowClosing', 'id': windowId})
+
+    def loadImage(self, window, message):
+        window.loadImage(message['path'], message['scale'])
+
+    def addImage(self, window, message):
+        '''
+        Add an image published by the main process to the image cache and let the windows pick it up.
+        If it's gone from shared memory already, the windows decode it themselves.
+        '''
+        key = tuple(message['key'])
+        if SourceFiles.instance().key(key[0]) != key[:2]:
+            SourceFiles.instance().refresh(key[0]) # Published before this process noticed the change
+        if ImageCache.instance().lookup(('image',) + key):
+            return # Decoded here already
+        cachedImage = SharedFrames.attach(message)
+        if cachedImage:
+            ImageCache.instance().addImage(cachedImage)
+            ImageLoader.instance().imageLoaded.emit(cachedImage.key[0], True)
+
+    def setScale(self, window, message):
+        window.setScale(message['scale'], message['smooth'])
+
+    def applySettings(self, window, message):
+        window.setMoveWithWindow(message['moveWithWindow'])
+        window.setKeepCentered(message['keepCentered'])
+        window.setSharedCanvas(message['sharedCanvas'])
+        window.setFastTransform(message.get('fastTransform', False))
+
+    def moveImage(self, window, message):
+        window.moveImage(window.mapFromGlobal(QPoint(*message['pos'])))
+        window.isImageMoved = False
+        self.sendState(message['id'], window)
+
+    def centerImage(self, window, message):
+        if window.centerImage():
+            self.sendState(message['id'], window)
+
+    def resetMoved(self, window, message):
+        window.isImageMoved = False
+
+    def setGifFrameInterval(self, window, message):
+        AnimationClock.instance().setMinFrameInterval(message['interval'])
+
+    def closeWindow(self, window, message):
+        window.close()
+
+    def quit(self, window, message):
+        for window in list(self.windows.values()):
+            window.close()
+        QApplication.instance().quit()
+
+def main():
+    '''
+    Entry point of a window host process, launched by the main window with the name of its local server and the index of the host.
+    '''
+    app = QApplication(sys.argv[:1])
+    app.setQuitOnLastWindowClosed(False) # The main process decides when the host is done
+    app.host = WindowHost(sys.argv[1], int(sys.argv[2])) # Kept alive for as long as the app runs
+    sys.exit(app.exec_())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import os
+import sys
+import itertools
+from PyQt5.QtCore import QObject, QPoint, QProcess, QSize, pyqtSignal
+from PyQt5.QtNetwork import QLocalServer
+from ImageCache import ImageCache
+from ImageLoader import ImageLoader
+from SharedFrames import SharedFrames
+from WindowHost import Channel
+
+class RemoteWindow(QObject):
+    '''
+    Stand-in for an image window hosted by a worker process, with the interface the main window and the sync scheduler use.
+    Calls are forwarded to the host as messages and the state the host reports back is mirrored here,
+    so imageMoved, windowClosing and needsSync work the same as for a window in this process.
+    '''
+    imageMoved = pyqtSignal(QPoint)
+    windowClosing = pyqtSignal(object)
+    needsSync = pyqtSignal()
+    visibilityChanged = pyqtSignal(bool)
+    geometryChanged = pyqtSignal(object)
+
+    def __init__(self, windowId, host, parent=None):
+        super().__init__(parent)
+        self.windowId = windowId
+        self.host = host
+        self.currentImagePath = None
+        self.moveWithWindow = False
+        self.keepCentered = False
+        self.sharedCanvas = False
+        self.fastTransform = False
+        self.imageMovedFlag = False
+        self.isShown = False
+        self.active = False
+        self.origin = QPoint() # Global position of the window's top left corner
+        self.imagePos = QPoint() # Global position of the image
+        self.windowSize = QSize()
+
+    @property
+    def isImageMoved(self):
+        return self.imageMovedFlag
+
+    @isImageMoved.setter
+    def isImageMoved(self, moved):
+        if self.imageMovedFlag and not moved:
+            self.send('resetMoved')
+        self.imageMovedFlag = moved
+
+    def send(self, messageType, **fields):
+        self.host.send(dict(type=messageType, id=self.windowId, **fields))
+
+    def settings(self):
+        return {'moveWithWindow': self.moveWithWindow, 'keepCentered': self.keepCentered, 'sharedCanvas': self.sharedCanvas,
+                'fastTransform': self.fastTransform}
+
+    def onState(self, message):
+        '''
+        Mirror the state reported by the host.
+        '''
+        self.origin = QPoint(*message['origin'])
+        self.imagePos = QPoint(*message['imagePos'])
+        self.windowSize = QSize(*message['size'])
+        self.active = message['active']
+        self.imageMovedFlag = message['moved']
+        self.geometryChanged.emit(self)
+        if message['shown'] != self.isShown:
+            self.isShown = message['shown']
+            self.visibilityChanged.emit(self.isShown)
+        if message['sync']:
+            self.needsSync.emit()
+
+    def onImageMoved(self, message):
+        self.imageMovedFlag = True
+        self.imageMoved.emit(QPoint(*message['pos']))
+
+    def show(self):
+        pass # The host shows the window as soon as it's opened
+
+    def close(self):
+        self.send('close')
+
+    def size(self):
+        return self.windowSize
+
+    def isActiveWindow(self):
+        return self.active
+
+    def mapToGlobal(self, pos):
+        return self.origin + pos
+
+    def imageGlobalPos(self):
+        return self.imagePos
+
+    def loadImage(self, imagePath, scaleFactor):
+        self.currentImagePath = imagePath
+        self.host.pool.loadImage(self, imagePath, scaleFactor)
+
+    def setScale(self, scaleFactor, smooth=True):
+        self.send('scale', scale=scaleFactor, smooth=smooth)
+
+    def setMoveWithWindow(self, state):
+        if state != self.moveWithWindow:
+            self.moveWithWindow = state
+            self.send('settings', **self.settings())
+
+    def setKeepCentered(self, state):
+        if state != self.keepCentered:
+            self.keepCentered = state
+            self.send('settings', **self.settings())
+            self.needsSync.emit()
+
+    def setSharedCanvas(self, state):
+        if state != self.sharedCanvas:
+            self.sharedCanvas = state
+            self.send('settings', **self.settings())
+
+    def setFastTransform(self, state):
+        if state != self.fastTransform:
+            self.fastTransform = state
+            self.send('settings', **self.settings())
+
+    def centerImage(self):
+        '''
+        Centered by the host, the new image position arrives with its next state report.
+        '''
+        self.send('center')
+        return False
+
+    def moveImage(self, localPos):
+        globalPos = self.mapToGlobal(localPos)
+        self.send('move', pos=[globalPos.x(), globalPos.y()])
+        return True
+
+class HostConnection(QObject):
+    '''
+    A single window host process as seen from the main process: the process, its channel and the windows it hosts.
+    '''
+    def __init__(self, pool, hostIndex, parent=None):
+        super().__init__(parent)
+        self.pool = pool
+        self.hostIndex = hostIndex
+        self.windows = {} # window id -> RemoteWindow
+        self.publishedKeys = set() # Keys of the images the host has been sent
+        self.channel = None
+        self.outbox = [] # Messages sent before the host connected
+
+        self.process = QProcess(self)
+        self.process.setProcessChannelMode(QProcess.ForwardedChannels)
+        self.process.setWorkingDirectory(os.getcwd()) # Image paths are relative to the main process
+        self.process.finished.connect(self.onFinished)
+        self.process.start(sys.executable, [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'WindowHost.py'),
+                                            pool.server.serverName(), str(hostIndex)])
+
+    def connectChannel(self, channel):
+        self.channel = channel
+        channel.messageReceived.connect(self.onMessage)
+        for message in self.outbox:
+            channel.send(message)
+        self.outbox = []
+
+    def send(self, message):
+        if self.channel:
+            self.channel.send(message)
+        else:
+            self.outbox.append(message)
+
+    def openWindow(self, windowId, settings):
+        window = RemoteWindow(windowId, self, self)
+        window.moveWithWindow = settings['moveWithWindow']
+        window.keepCentered = settings['keepCentered']
+        window.sharedCanvas = settings['sharedCanvas']
+        self.windows[windowId] = window
+        self.send(dict(type='open', id=windowId, **settings))
+        return window
+
+    def onMessage(self, message):
+        window = self.windows.get(message.get('id'))
+        if window is None:
+            return
+        if message['type'] == 'state':
+            window.onState(message)
+        elif message['type'] == 'imageMoved':
+            window.onImageMoved(message)
+        elif message['type'] == 'windowClosing':
+            self.closeWindow(window)
+
+    def closeWindow(self, window):
+        del self.windows[window.windowId]
+        window.windowClosing.emit(window)
+        window.deleteLater()
+
+    def onFinished(self):
+        '''
+        The host process exited or crashed, its windows are gone.
+        '''
+        for window in list(self.windows.values()):
+            self.closeWindow(window)
+        self.pool.removeHost(self)
+
+    def quit(self):
+        self.send({'type': 'quit'})
+        if self.channel:
+            self.channel.socket.flush()
+        self.process.waitForFinished(1000)
+
+class WindowHostPool(QObject):
+    '''
+    Spreads image windows over worker processes, each hosting up to WINDOWS_PER_HOST windows, for as many processes as there are spare cores.
+    Decoded images are published into shared memory once and picked up by every host instead of being decoded in each of them.
+    '''
+    WINDOWS_PER_HOST = 25
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.maxHosts = max(1, (os.cpu_count() or 2) - 1) # One core stays with the main process
+        self.hosts = []
+        self.hostIndexes = itertools.count()
+        self.windowIds = itertools.count()
+        self.pendingLoads = {} # path -> [(window, scale factor)] waiting for the image to be decoded
+        self.gifFrameInterval = 0 # Minimum time in ms between GIF frames in all the hosts
+
+        self.server = QLocalServer(self)
+        self.server.newConnection.connect(self.onNewConnection)
+        QLocalServer.removeServer('MultiWindowSync-{}'.format(os.getpid()))
+        self.server.listen('MultiWindowSync-{}'.format(os.getpid()))
+        ImageLoader.instance().imageLoaded.connect(self.onImageLoaded)
+
+    def createWindow(self, settings):
+        '''
+        Open a window in the host with the fewest windows, starting a new host if all of them are full.
+        '''
+        host = min(self.hosts, key=lambda host: len(host.windows), default=None)
+        if host is None or (len(host.windows) >= self.WINDOWS_PER_HOST and len(self.hosts) < self.maxHosts):
+            host = HostConnection(self, next(self.hostIndexes), self)
+            self.hosts.append(host)
+            if self.gifFrameInterval:
+                host.send({'type': 'gifFrameInterval', 'interval': self.gifFrameInterval})
+            for description in SharedFrames.instance().descriptions():
+                host.publishedKeys.add(tuple(description['key']))
+                host.send(dict(type='image', **description))
+        return host.openWindow(next(self.windowIds), settings)
+
+    def onNewConnection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            channel = Channel(socket, socket)
+            channel.messageReceived.connect(lambda message, channel=channel: self.onHello(channel, message))
+
+    def onHello(self, channel, message):
+        if message['type'] != 'hello':
+            return
+        channel.messageReceived.disconnect()
+        for host in self.hosts:
+            if host.hostIndex == message['host']:
+                host.connectChannel(channel)
+
+    def loadImage(self, window, imagePath, scaleFactor):
+        '''
+        Publish the image to the hosts and let the window load it. If it isn't decoded yet,
+        it's decoded once here and the window loads it once it's published.
+        '''
+        targetSize = window.size() * scaleFactor if window.size().isValid() else None
+        cachedImage = ImageCache.instance().cachedImage(imagePath, targetSize)
+        if cachedImage is None:
+            self.pendingLoads.setdefault(imagePath, []).append((window, scaleFactor))
+            ImageLoader.instance().requestImage(imagePath, targetSize)
+            return
+        self.publish(cachedImage)
+        window.send('load', path=imagePath, scale=scaleFactor)
+
+    def onImageLoaded(self, imagePath, loaded):
+        pending = self.pendingLoads.pop(imagePath, [])
+        cachedImage = ImageCache.instance().cachedImage(imagePath, allowSmaller=True) if loaded else None
+        if cachedImage:
+            self.publish(cachedImage)
+        for window, scaleFactor in pending:
+            window.send('load', path=imagePath, scale=scaleFactor) # Decoded by the host itself if it couldn't be published
+
+    def publish(self, cachedImage):
+        description = SharedFrames.instance().publish(cachedImage)
+        if description is None:
+            return
+        for host in self.hosts:
+            if cachedImage.key not in host.publishedKeys:
+                host.publishedKeys.add(cachedImage.key)
+                host.send(dict(type='image', **description))
+
+    def setGifFrameInterval(self, interval):
+        '''
+        Lower the frame rate of the GIFs in all the hosts, like the animation clock of this process.
+        '''
+        self.gifFrameInterval = interval
+        for host in self.hosts:
+            host.send({'type': 'gifFrameInterval', 'interval': interval})
+
+    def removeHost(self, host):
+        if host in self.hosts:
+            self.hosts.remove(host)
+            host.deleteLater()
+
+    def shutdown(self):
+        '''
+        Close all the hosts and release the shared memory.
+        '''
+        for host in list(self.hosts):
+            host.process.finished.disconnect()
+            host.quit()
+        self.hosts.clear()
+        SharedFrames.instance().clear()